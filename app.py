@@ -1,31 +1,223 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Blueprint, Flask, Response, current_app, render_template, request, redirect, url_for, session, flash, jsonify, send_file, abort, g
 from werkzeug.security import check_password_hash
 from datetime import datetime
-from db.dbhelper import *
+from db.dbhelper import (
+    EXPORT_COLUMNS, MAX_BATCH_EVENTS, check_hot_query_plans, create_student, create_user,
+    day_bounds, delete_student, delete_user, follow_attendance, get_all_users, get_attendance_page,
+    get_attendance_summary, get_latest_attendance_id, get_student_by_id, get_student_by_idno, get_students_page,
+    get_user_by_email, iter_attendance, mark_attendance_by_idno, ph_now, prune_photos,
+    rebuild_attendance_aggregates, record_attendance, record_attendance_batch, search_students,
+    select_students, set_student_photo, start_attendance_writer, update_student, update_user,
+)
+from db.connection import close_request_db
+from db.metrics import registry
+from db.migrations import run_migrations
+from db import connection, photostore
+from db.presence import today_presence
+from db.roster_import import import_students, RosterImportError
+from db.reports import REPORTS, run_report
+from db import archive, jobs
+from exports import FORMATS, stream_body
+from cards import build_zip, zip_name
+import tasks
 import base64
+import click
+import json
+import logging
+import secrets
+import sqlite3
 import os
+import time
+from werkzeug.utils import secure_filename
 
-app = Flask(__name__)
-app.secret_key = 'your-secret-key-here-change-in-production'
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
+# LOG_LEVEL=DEBUG shows per-request detail; debug calls are skipped otherwise
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+# Every route and CLI command lives on this blueprint; create_app() builds
+# an app around it. `flask --app app` finds create_app() by itself.
+bp = Blueprint('main', __name__, cli_group=None)
+
+def create_app(config=None):
+    """Build the application; config (a mapping) overrides settings taken from the environment
+
+    With WARM_UP on (the default) the process is made ready to serve here.
+    serve.py turns it off and calls warm_up() in each worker after forking,
+    since connections and threads must not be carried across a fork.
+    """
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY=os.environ.get('SECRET_KEY'),
+        MAX_CONTENT_LENGTH=50 * 1024 * 1024,  # 50MB max file size
+        DATABASE=connection.DATABASE,
+        WARM_UP=True,
+        # ATTENDANCE_WRITER=group batches kiosk inserts into group commits
+        ATTENDANCE_WRITER=os.environ.get('ATTENDANCE_WRITER', 'direct'),
+        ATTENDANCE_WRITER_MAX_BATCH=int(os.environ.get('ATTENDANCE_WRITER_MAX_BATCH', 200)),
+        ATTENDANCE_WRITER_MAX_DELAY_MS=float(os.environ.get('ATTENDANCE_WRITER_MAX_DELAY_MS', 5)),
+        ATTENDANCE_WRITER_QUEUE_SIZE=int(os.environ.get('ATTENDANCE_WRITER_QUEUE_SIZE', 2000)),
+        ATTENDANCE_WRITER_DURABILITY=os.environ.get('ATTENDANCE_WRITER_DURABILITY', 'normal'),
+    )
+    app.config.update(config or {})
+    if app.config['DATABASE'] != connection.DATABASE:
+        connection.configure(database=app.config['DATABASE'])
+    if not app.config['SECRET_KEY']:
+        app.config['SECRET_KEY'] = load_secret_key()
+
+    app.register_blueprint(bp)
+    # One pooled connection per request, handed back when the request ends
+    app.teardown_appcontext(close_request_db)
+
+    if app.config['WARM_UP']:
+        warm_up(app)
+    return app
+
+def load_secret_key():
+    """A random key kept in secret_key next to the database, created on first use
+
+    Every worker process reads the same file, and it outlives restarts, so
+    sessions stay valid across both. Set SECRET_KEY to use your own.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(connection.DATABASE)), 'secret_key')
+    if not os.path.exists(path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            # Linking fails if another process got there first; its key wins
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+def warm_up(app):
+    """Make this process ready to serve before its first request
+
+    Brings the schema up to date (each migration takes the write lock and
+    re-reads the version, so concurrent workers apply it once), opens the
+    pooled connections, loads today's presence set and every template, and
+    starts the background threads.
+    """
+    run_migrations()
+    connection.warm_pools()
+    # Load today's present students so repeat scans never reach the database
+    today_presence.warm(ph_now()[0])
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    if app.config['ATTENDANCE_WRITER'] == 'group':
+        start_attendance_writer(max_batch=app.config['ATTENDANCE_WRITER_MAX_BATCH'],
+                                max_delay=app.config['ATTENDANCE_WRITER_MAX_DELAY_MS'] / 1000,
+                                queue_size=app.config['ATTENDANCE_WRITER_QUEUE_SIZE'],
+                                durability=app.config['ATTENDANCE_WRITER_DURABILITY'])
+    # Pick up background jobs a previous run left unfinished, including any
+    # term archive left half moved
+    jobs.resume_jobs()
+    tasks.resume_archives()
+
+@bp.cli.command('prune-photos')
+def prune_photos_command():
+    """Delete stored photos that no student refers to"""
+    print(f"Removed {prune_photos()} unreferenced photo(s).")
+
+@bp.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a hot query's plan falls back to a full table scan"""
+    problems = check_hot_query_plans()
+    for name, plan in problems.items():
+        print(f"{name}: {' / '.join(plan)}")
+    if problems:
+        raise SystemExit(1)
+    print('All hot queries use an index.')
+
+@bp.cli.command('rebuild-aggregates')
+def rebuild_aggregates_command():
+    """Recompute the daily attendance aggregates from the attendance table"""
+    print(f"Rebuilt {rebuild_attendance_aggregates()} daily aggregate row(s).")
+
+def _term_date(ctx, param, value):
+    # Term dates are compared as text against zero-padded timestamps
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise click.BadParameter('dates must be YYYY-MM-DD')
+
+@bp.cli.command('archive-term')
+@click.argument('name')
+@click.argument('first_date', callback=_term_date)
+@click.argument('last_date', callback=_term_date)
+def archive_term_command(name, first_date, last_date):
+    """Move a closed term's attendance into its own archive file (resumable)"""
+    try:
+        archive.register_term(name, first_date, last_date, ph_now()[0])
+    except archive.ArchiveError as e:
+        raise click.ClickException(str(e))
+    print(f"Archived {archive.archive_term(name)} attendance row(s) of term {name}.")
+
+# Request timing for /metrics
+registry.describe('http_request_seconds', 'Request handling time by endpoint and method')
+registry.describe('http_responses_total', 'Responses by endpoint and status code')
+
+@bp.before_app_request
+def start_request_timer():
+    g._request_started = time.perf_counter()
+
+@bp.after_app_request
+def record_request_metrics(response):
+    started = g.pop('_request_started', None)
+    if started is not None:
+        # Unrouted requests share one label so stray URLs cannot blow up the series
+        endpoint = request.endpoint or 'unmatched'
+        registry.observe('http_request_seconds', time.perf_counter() - started,
+                         endpoint=endpoint, method=request.method)
+        registry.inc('http_responses_total', endpoint=endpoint, status=str(response.status_code))
+    return response
+
+# Rows per page on the admin lists; the JSON APIs accept up to MAX_PAGE_SIZE
+STUDENT_PAGE_SIZE = 50
+ATTENDANCE_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
 
 def login_required(f):
     """Decorator to check if user is logged in"""
     def decorated_function(*args, **kwargs):
         if 'admin_logged_in' not in session:
             flash('Please login first', 'danger')
-            return redirect(url_for('admin_login'))
+            return redirect(url_for('main.admin_login'))
         return f(*args, **kwargs)
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+def student_card(student):
+    """Student fields shown on the kiosk card"""
+    return {
+        'idno': student['idno'],
+        'firstname': student['firstname'],
+        'lastname': student['lastname'],
+        'course': student['course'],
+        'level': student['level']
+    }
+
+def photo_url(student):
+    """Cacheable URL of the student's photo, or None
+
+    The URL contains the photo's content hash, so it changes whenever the
+    photo does and browsers can keep it forever.
+    """
+    if student['photo_hash']:
+        return url_for('main.student_photo', photo_hash=student['photo_hash'])
+    return None
+
 # Routes
-@app.route('/')
+@bp.route('/')
 def index():
     """Homepage with QR code reader"""
     return render_template("index.html")
 
-@app.route('/admin/login', methods=['GET', 'POST'])
+@bp.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
     """Admin login page"""
     if request.method == 'POST':
@@ -39,26 +231,26 @@ def admin_login():
             session['user_id'] = user['id']
             session['user_email'] = user['email']
             flash('Login successful!', 'success')
-            return redirect(url_for('user_management'))
+            return redirect(url_for('main.user_management'))
         else:
             flash('Invalid email or password', 'danger')
     
     return render_template('admin_login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Logout admin"""
     session.clear()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
-@app.route('/admin/users')
+@bp.route('/admin/users')
 @login_required
 def user_management():
     """User management page"""
     users = get_all_users()
     return render_template('user_management.html', users=users)
 
-@app.route('/admin/users/save', methods=['POST'])
+@bp.route('/admin/users/save', methods=['POST'])
 @login_required
 def save_user():
     """Save or update user"""
@@ -69,7 +261,7 @@ def save_user():
     
     if not email or not password or not name:
         flash('Email, name and password are required', 'danger')
-        return redirect(url_for('user_management'))
+        return redirect(url_for('main.user_management'))
     
     try:
         if user_id:
@@ -85,34 +277,57 @@ def save_user():
     except Exception as e:
         flash(str(e), 'danger')
     
-    return redirect(url_for('user_management'))
+    return redirect(url_for('main.user_management'))
 
-@app.route('/admin/users/delete/<int:user_id>', methods=['POST'])
+@bp.route('/admin/users/delete/<int:user_id>', methods=['POST'])
 @login_required
 def delete_user_route(user_id):
     """Delete user"""
     if session.get('user_id') == user_id:
         flash('Cannot delete your own account', 'danger')
-        return redirect(url_for('user_management'))
+        return redirect(url_for('main.user_management'))
     
     delete_user(user_id)
     flash('Admin deleted successfully!', 'success')
-    return redirect(url_for('user_management'))
+    return redirect(url_for('main.user_management'))
 
-@app.route('/admin/students')
+@bp.route('/admin/students')
 @login_required
 def student_management():
     """Student management page"""
-    students = get_all_students()
-    # Sort students numerically by idno
+    course = request.args.get('course') or None
+    level = request.args.get('level') or None
+    # First page only; the page fetches the rest from /api/students as it scrolls
+    students, next_cursor = get_students_page(limit=STUDENT_PAGE_SIZE, course=course, level=level)
+    return render_template('student_management.html', students=students, next_cursor=next_cursor,
+                           course=course, level=level)
+
+@bp.route('/api/students')
+@login_required
+def students_api():
+    """One page of students in IDNO order for infinite scrolling"""
     try:
-        students = sorted(students, key=lambda s: int(s['idno']))
-    except (ValueError, TypeError):
-        # If idno cannot be converted to int, sort alphabetically
-        students = sorted(students, key=lambda s: s['idno'])
-    return render_template('student_management.html', students=students)
+        limit = max(1, min(int(request.args.get('limit', STUDENT_PAGE_SIZE)), MAX_PAGE_SIZE))
+        students, next_cursor = get_students_page(after=request.args.get('after') or None, limit=limit,
+                                                  course=request.args.get('course') or None,
+                                                  level=request.args.get('level') or None)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid page request'}), 400
+    return jsonify({'success': True, 'students': [dict(student) for student in students], 'next': next_cursor})
 
-@app.route('/admin/students/add', methods=['GET', 'POST'])
+@bp.route('/api/students/search')
+@login_required
+def search_students_api():
+    """Typeahead search over the roster by IDNO, name or course"""
+    query = request.args.get('q', '')
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), 50))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid limit'}), 400
+    students = search_students(query, limit)
+    return jsonify({'success': True, 'students': [dict(student) for student in students]})
+
+@bp.route('/admin/students/add', methods=['GET', 'POST'])
 @login_required
 def add_student():
     """Add or edit student"""
@@ -126,49 +341,50 @@ def add_student():
         course = request.form.get('course')
         level = request.form.get('level')
         photo_data = request.form.get('photo')
+        photo_file = request.files.get('photo_file')
         student_id = request.form.get('student_id') or student_id
         
-        print(f"DEBUG: Request method: POST")
-        print(f"DEBUG: Form data - idno: {idno}, firstname: {firstname}, lastname: {lastname}")
-        print(f"DEBUG: Student ID: {student_id}")
-        print(f"DEBUG: Photo data present: {bool(photo_data)}")
-        if photo_data:
-            print(f"DEBUG: Photo data preview: {photo_data[:100]}")
+        current_app.logger.debug('Saving student: id=%s idno=%s name=%s %s photo=%s',
+                         student_id, idno, firstname, lastname, bool(photo_data or photo_file))
         
         if not all([idno, firstname, lastname, course, level]):
             return jsonify({'success': False, 'message': 'All fields are required'})
         
-        # Convert base64 photo to binary
+        photo_hash = None
         photo_binary = None
-        if photo_data and photo_data.startswith('data:image'):
-            import base64
+        if photo_file:
+            # Binary upload: streamed into the photo store in chunks
+            try:
+                photo_hash = photostore.put_stream(photo_file.stream)
+            except photostore.PhotoRejected as e:
+                return jsonify({'success': False, 'message': str(e)})
+        elif photo_data and photo_data.startswith('data:image'):
+            # Legacy path: base64 data URI in a form field
             try:
                 photo_binary = base64.b64decode(photo_data.split(',')[1])
-                print(f"DEBUG: Converted photo to binary, size: {len(photo_binary)} bytes")
-            except Exception as e:
-                print(f"DEBUG: Error converting photo: {str(e)}")
+                current_app.logger.debug('Decoded photo, %d bytes', len(photo_binary))
+            except Exception:
+                current_app.logger.warning('Could not decode photo for student %s', idno, exc_info=True)
                 return jsonify({'success': False, 'message': 'Error processing photo'})
-        else:
-            print(f"DEBUG: Photo data not in expected format")
+        elif photo_data:
+            current_app.logger.debug('Photo data not in expected format')
         
         try:
             if student_id:
-                if update_student(student_id, idno, firstname, lastname, course, level, photo_binary):
-                    print(f"DEBUG: Student {student_id} updated successfully")
+                if update_student(student_id, idno, firstname, lastname, course, level, photo_binary, photo_hash):
+                    current_app.logger.debug('Student %s updated', student_id)
                     return jsonify({'success': True, 'id': student_id, 'message': 'Student updated successfully!'})
                 else:
                     return jsonify({'success': False, 'message': 'Student ID already exists'})
             else:
-                result = create_student(idno, firstname, lastname, course, level, photo_binary)
-                print(f"DEBUG: Create student result: {result}")
-                if result:
-                    # Get the newly created student ID
-                    new_student = get_student_by_idno(idno)
-                    return jsonify({'success': True, 'id': new_student['id'], 'message': 'Student created successfully!'})
+                new_id = create_student(idno, firstname, lastname, course, level, photo_binary, photo_hash)
+                current_app.logger.debug('Create student result: %s', new_id)
+                if new_id:
+                    return jsonify({'success': True, 'id': new_id, 'message': 'Student created successfully!'})
                 else:
                     return jsonify({'success': False, 'message': 'Student ID already exists'})
         except Exception as e:
-            print(f"DEBUG: Exception during save: {str(e)}")
+            current_app.logger.exception('Error saving student %s', idno)
             return jsonify({'success': False, 'message': str(e)})
     
     if student_id:
@@ -176,10 +392,75 @@ def add_student():
     
     return render_template('add_student.html', student=student)
 
-@app.route('/api/student/data', methods=['GET'])
+@bp.route('/photos/<photo_hash>')
+def student_photo(photo_hash):
+    """Serve a stored photo with long-lived caching, ETag and Range support"""
+    if not photostore.is_valid_hash(photo_hash) or photostore.size(photo_hash) is None:
+        abort(404)
+    response = send_file(photostore.path_for(photo_hash),
+                         mimetype=photostore.mimetype(photo_hash),
+                         conditional=True, etag=photo_hash,
+                         max_age=365 * 24 * 60 * 60)
+    response.cache_control.immutable = True
+    return response
+
+@bp.route('/admin/students/import', methods=['GET', 'POST'])
+@login_required
+def import_students_route():
+    """Bulk import students from a CSV, with an optional zip of photos"""
+    if request.method == 'GET':
+        return render_template('import_students.html', report=None)
+    
+    wants_json = request.accept_mimetypes.best == 'application/json'
+    roster = request.files.get('roster')
+    photos = request.files.get('photos')
+    if not roster or not roster.filename:
+        message = 'Please choose a CSV file'
+        if wants_json:
+            return jsonify({'success': False, 'message': message}), 400
+        flash(message, 'danger')
+        return redirect(url_for('main.import_students_route'))
+    
+    try:
+        report = import_students(roster.stream, photos.stream if photos and photos.filename else None)
+    except RosterImportError as e:
+        if wants_json:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        flash(str(e), 'danger')
+        return redirect(url_for('main.import_students_route'))
+    
+    if wants_json:
+        return jsonify({'success': True, 'report': report})
+    return render_template('import_students.html', report=report)
+
+@bp.route('/admin/students/qrcodes')
+@login_required
+def download_qrcodes():
+    """Zip of QR code PNGs, plus printable ID-card sheets with cards=1
+
+    Students are chosen by ids (comma-separated student ids) and/or the
+    course and level filters; with none of them every student is included.
+    """
+    course = request.args.get('course') or None
+    level = request.args.get('level') or None
+    with_cards = request.args.get('cards') in ('1', 'true', 'yes')
+    ids = request.args.get('ids')
+    try:
+        student_ids = [int(value) for value in ids.split(',') if value.strip()] if ids else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'ids must be comma-separated student ids'}), 400
+    
+    students = select_students(student_ids, course, level)
+    if not students:
+        return jsonify({'success': False, 'message': 'No students selected'}), 404
+    filename = zip_name(course, level, with_cards)
+    return Response(build_zip(students, cards=with_cards), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={secure_filename(filename)}'})
+
+@bp.route('/api/student/data', methods=['GET'])
 @login_required
 def get_student_data():
-    """Get student data including photo as base64"""
+    """Get student data including the photo URL"""
     student_id = request.args.get('id')
     if not student_id:
         return jsonify({'success': False, 'message': 'Student ID required'}), 400
@@ -188,14 +469,6 @@ def get_student_data():
     if not student:
         return jsonify({'success': False, 'message': 'Student not found'}), 404
     
-    photo_base64 = None
-    try:
-        if student['photo']:
-            import base64
-            photo_base64 = base64.b64encode(student['photo']).decode('utf-8')
-    except (KeyError, TypeError):
-        pass
-    
     return jsonify({
         'success': True,
         'student': {
@@ -206,32 +479,260 @@ def get_student_data():
             'course': student['course'],
             'level': student['level']
         },
-        'photo': photo_base64
+        'photo_url': photo_url(student)
     })
 
-@app.route('/admin/students/save', methods=['POST'])
+@bp.route('/admin/students/save', methods=['POST'])
 @login_required
 def save_student():
     """Save student (for compatibility)"""
     return add_student()
 
-@app.route('/admin/students/delete/<int:student_id>', methods=['POST'])
+@bp.route('/admin/students/delete/<int:student_id>', methods=['POST'])
 @login_required
 def delete_student_route(student_id):
     """Delete student"""
     delete_student(student_id)
     flash('Student deleted successfully!', 'success')
-    return redirect(url_for('student_management'))
+    return redirect(url_for('main.student_management'))
 
-@app.route('/admin/attendance')
+@bp.route('/admin/attendance')
 @login_required
 def view_attendance():
     """View attendance records"""
-    date_filter = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
-    attendance = get_attendance_by_date(date_filter)
-    return render_template('view_attendance.html', attendance=attendance, date_filter=date_filter)
+    date_filter = request.args.get('date') or ph_now()[0]
+    # Taken before the page query so the live feed cannot miss a row
+    last_id = get_latest_attendance_id()
+    attendance, next_cursor = get_attendance_page(date_filter, limit=ATTENDANCE_PAGE_SIZE)
+    summary = get_attendance_summary(date_filter, date_filter)
+    day = summary['days'][0] if summary['days'] else None
+    return render_template('view_attendance.html', attendance=attendance, date_filter=date_filter,
+                           next_cursor=next_cursor, summary=day, enrolled=summary['enrolled'],
+                           live=date_filter == ph_now()[0], last_id=last_id)
+
+# Live feed timing: heartbeats keep proxies from closing an idle stream, and
+# each stream ends after SSE_LIFETIME so its server thread is freed; the
+# browser reconnects with Last-Event-ID and carries on where it stopped
+SSE_HEARTBEAT = 15
+SSE_LIFETIME = 300
+
+@bp.route('/admin/attendance/stream')
+@login_required
+def attendance_stream():
+    """Server-Sent Events feed of new attendance rows for one day"""
+    date_filter = request.args.get('date') or ph_now()[0]
+    try:
+        day_bounds(date_filter)
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_id') or 0)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid date or last_id'}), 400
+    
+    def events():
+        yield 'retry: 3000\n\n'
+        for records in follow_attendance(date_filter, last_id, heartbeat=SSE_HEARTBEAT, lifetime=SSE_LIFETIME):
+            if not records:
+                yield ': keepalive\n\n'
+            for record in records:
+                yield f"id: {record['id']}\nevent: attendance\ndata: {json.dumps(record)}\n\n"
+    
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Longest range the summary API will cover in one request
+MAX_SUMMARY_DAYS = 366
+
+@bp.route('/api/attendance/summary')
+@login_required
+def attendance_summary_api():
+    """Daily present/absent counts by course and level, from the aggregates"""
+    end = request.args.get('end') or ph_now()[0]
+    start = request.args.get('start') or end
+    try:
+        start_day = datetime.strptime(start, '%Y-%m-%d')
+        end_day = datetime.strptime(end, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Dates must be YYYY-MM-DD'}), 400
+    if start_day > end_day or (end_day - start_day).days >= MAX_SUMMARY_DAYS:
+        return jsonify({'success': False, 'message': f'Range must be 1 to {MAX_SUMMARY_DAYS} days'}), 400
+    summary = get_attendance_summary(start, end)
+    summary['success'] = True
+    return jsonify(summary)
 
-@app.route('/api/scan/<idno>')
+@bp.route('/api/attendance/list')
+@login_required
+def attendance_list_api():
+    """One page of a day's attendance in time-in order for infinite scrolling"""
+    date_filter = request.args.get('date') or ph_now()[0]
+    try:
+        limit = max(1, min(int(request.args.get('limit', ATTENDANCE_PAGE_SIZE)), MAX_PAGE_SIZE))
+        attendance, next_cursor = get_attendance_page(date_filter, after=request.args.get('after') or None,
+                                                      limit=limit)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid page request'}), 400
+    return jsonify({'success': True, 'attendance': attendance, 'next': next_cursor})
+
+@bp.route('/admin/attendance/export')
+@login_required
+def export_attendance():
+    """Stream attendance history as CSV or NDJSON, optionally gzipped"""
+    fmt = request.args.get('format', 'csv')
+    start = request.args.get('start') or None
+    end = request.args.get('end') or None
+    course = request.args.get('course') or None
+    level = request.args.get('level') or None
+    use_gzip = request.args.get('gzip') in ('1', 'true', 'yes')
+    
+    if fmt not in FORMATS:
+        return jsonify({'success': False, 'message': 'format must be csv or ndjson'}), 400
+    try:
+        for value in (start, end):
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Dates must be YYYY-MM-DD'}), 400
+    
+    rows = iter_attendance(start, end, course, level)
+    body, mimetype, extension = stream_body(fmt, EXPORT_COLUMNS, rows, gzip=use_gzip)
+    filename = f"attendance_{start or 'all'}_{end or 'all'}.{extension}"
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@bp.route('/admin/reports/<kind>')
+@login_required
+def attendance_report(kind):
+    """Per-student attendance rates or absentee lists over a date range
+
+    format=json (default) returns the rows inline; csv or ndjson stream a
+    download. start defaults to the first of the month, end to today.
+    """
+    if kind not in REPORTS:
+        abort(404)
+    fmt = request.args.get('format', 'json')
+    today = ph_now()[0]
+    start = request.args.get('start') or today[:8] + '01'
+    end = request.args.get('end') or today
+    course = request.args.get('course') or None
+    level = request.args.get('level') or None
+    
+    if fmt != 'json' and fmt not in FORMATS:
+        return jsonify({'success': False, 'message': 'format must be json, csv or ndjson'}), 400
+    try:
+        if datetime.strptime(start, '%Y-%m-%d') > datetime.strptime(end, '%Y-%m-%d'):
+            return jsonify({'success': False, 'message': 'start must not be after end'}), 400
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Dates must be YYYY-MM-DD'}), 400
+    
+    try:
+        columns, rows = run_report(kind, start, end, course, level)
+    except archive.ArchiveError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if fmt == 'json':
+        return jsonify({'success': True, 'report': kind, 'start': start, 'end': end,
+                        'rows': [dict(zip(columns, row)) for row in rows]})
+    use_gzip = request.args.get('gzip') in ('1', 'true', 'yes')
+    body, mimetype, extension = stream_body(fmt, columns, rows, gzip=use_gzip)
+    filename = f"{kind}_{start}_{end}.{extension}"
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@bp.route('/admin/attendance/archive', methods=['GET', 'POST'])
+@login_required
+def archive_attendance():
+    """List archived terms, or start archiving one as a background job
+
+    POST a JSON or form body with name, first_date and last_date
+    (YYYY-MM-DD). Posting a term again resumes an unfinished or paused move.
+    """
+    if request.method == 'GET':
+        return jsonify({'success': True, 'terms': archive.list_terms()})
+    data = request.get_json(silent=True) or request.form
+    name = data.get('name', '')
+    first_date = data.get('first_date', '')
+    last_date = data.get('last_date', '')
+    try:
+        first_date, last_date = (datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+                                 for value in (first_date, last_date))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Dates must be YYYY-MM-DD'}), 400
+    try:
+        archive.register_term(name, first_date, last_date, ph_now()[0])
+    except archive.ArchiveError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    try:
+        job_id = tasks.start_archive(name)
+    except jobs.JobsBusy as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
+    return jsonify({'success': True, 'job': jobs.get_job(job_id), 'status_url': url_for('main.job_status', job_id=job_id),
+                    'terms': archive.list_terms()}), 202
+
+# Background jobs: submit, poll, cancel, download
+
+@bp.route('/admin/jobs')
+@login_required
+def list_jobs():
+    """Recent background jobs, optionally of one kind or status"""
+    kind = request.args.get('kind') or None
+    status = request.args.get('status') or None
+    return jsonify({'success': True, 'jobs': jobs.list_jobs(kind, [status] if status else None)})
+
+@bp.route('/admin/jobs/<kind>', methods=['POST'])
+@login_required
+def submit_job(kind):
+    """Start a background job; params come as JSON or form fields, uploads as files"""
+    if kind not in jobs.KINDS:
+        abort(404)
+    params = request.get_json(silent=True) or request.form.to_dict()
+    files = {name: (upload.filename, upload.stream) for name, upload in request.files.items() if upload.filename}
+    try:
+        job_id = jobs.submit(kind, params, files)
+    except jobs.JobError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except jobs.JobsBusy as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
+    return jsonify({'success': True, 'job': jobs.get_job(job_id),
+                    'status_url': url_for('main.job_status', job_id=job_id)}), 202
+
+@bp.route('/admin/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    """A job's status and progress"""
+    job = jobs.get_job(job_id)
+    if job is None:
+        abort(404)
+    if job['result_name'] and job['status'] == 'done':
+        job['result_url'] = url_for('main.job_result', job_id=job_id)
+    return jsonify({'success': True, 'job': job})
+
+@bp.route('/admin/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    """Cancel a queued job, or ask a running one to stop"""
+    job = jobs.cancel(job_id)
+    if job is None:
+        abort(404)
+    return jsonify({'success': True, 'job': job})
+
+@bp.route('/admin/jobs/<int:job_id>/result')
+@login_required
+def job_result(job_id):
+    """Download a finished job's file"""
+    try:
+        path, filename, mimetype = jobs.result_file(job_id)
+    except jobs.JobError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    return send_file(path, mimetype=mimetype, as_attachment=True, download_name=secure_filename(filename))
+
+# Scrapes are only answered on the loopback interface
+METRICS_ADDRESSES = ('127.0.0.1', '::1')
+
+@bp.route('/metrics')
+def metrics():
+    """Prometheus text-format metrics for local scrapers"""
+    if request.remote_addr not in METRICS_ADDRESSES:
+        abort(404)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/api/scan/<idno>')
 def scan_student(idno):
     """Get student information by scanning QR code"""
     student = get_student_by_idno(idno)
@@ -239,30 +740,70 @@ def scan_student(idno):
     if not student:
         return jsonify({'success': False, 'message': 'Student not found'}), 404
     
-    photo_base64 = None
-    try:
-        if student['photo']:
-            import base64
-            photo_base64 = base64.b64encode(student['photo']).decode('utf-8')
-    except (KeyError, TypeError):
-        pass
-    
     return jsonify({
         'success': True,
-        'student': {
-            'idno': student['idno'],
-            'firstname': student['firstname'],
-            'lastname': student['lastname'],
-            'course': student['course'],
-            'level': student['level']
-        },
-        'photo': photo_base64
+        'student': student_card(student),
+        'photo_url': photo_url(student)
     })
 
-@app.route('/api/save-photo', methods=['POST'])
+# Binary uploads of one image: at most photostore.MAX_PHOTO_BYTES of image
+# plus a little multipart framing
+MAX_IMAGE_REQUEST_BYTES = photostore.MAX_PHOTO_BYTES + 64 * 1024
+IMAGE_MIMETYPES = ('image/jpeg', 'image/png')
+
+def image_upload_stream(field):
+    """The uploaded image as a stream: a raw image body, or a multipart file field"""
+    if request.mimetype in IMAGE_MIMETYPES:
+        return request.stream
+    upload = request.files.get(field)
+    return upload.stream if upload else None
+
+def image_upload_error(e):
+    """JSON response for a rejected image upload"""
+    status = 413 if isinstance(e, photostore.PhotoTooLarge) else 400
+    return jsonify({'success': False, 'message': str(e)}), status
+
+def save_static_image(stream, folder, filename):
+    """Stream an uploaded image into static/<folder>/<filename>, replacing it atomically"""
+    directory = os.path.join(current_app.root_path, 'static', folder)
+    tmp_path, _, _ = photostore.spool(stream, directory)
+    os.replace(tmp_path, os.path.join(directory, filename))
+
+@bp.route('/api/students/<int:student_id>/photo', methods=['POST', 'PUT'])
+@login_required
+def upload_student_photo(student_id):
+    """Replace a student's photo from a raw JPEG/PNG body or a multipart 'photo' file"""
+    if request.content_length and request.content_length > MAX_IMAGE_REQUEST_BYTES:
+        return jsonify({'success': False, 'message': 'Photo is too large'}), 413
+    stream = image_upload_stream('photo')
+    if stream is None:
+        return jsonify({'success': False, 'message': 'Send image/jpeg or image/png, or a multipart photo field'}), 415
+    try:
+        photo_hash = photostore.put_stream(stream)
+    except photostore.PhotoRejected as e:
+        return image_upload_error(e)
+    if not set_student_photo(student_id, photo_hash):
+        return jsonify({'success': False, 'message': 'Student not found'}), 404
+    return jsonify({'success': True, 'photo_url': url_for('main.student_photo', photo_hash=photo_hash)})
+
+@bp.route('/api/save-photo', methods=['POST'])
 @login_required
 def save_photo():
     """Save captured photo to static/images folder"""
+    if request.files:
+        # Multipart upload, streamed to disk
+        if request.content_length and request.content_length > MAX_IMAGE_REQUEST_BYTES:
+            return jsonify({'success': False, 'error': 'Photo is too large'}), 413
+        stream = image_upload_stream('photo')
+        if stream is None:
+            return jsonify({'success': False, 'error': 'No photo uploaded'}), 400
+        filename = secure_filename(f"{request.form.get('firstname', '')}_{request.form.get('lastname', '')}.jpg")
+        try:
+            save_static_image(stream, 'images', filename)
+        except photostore.PhotoRejected as e:
+            return image_upload_error(e)
+        return jsonify({'success': True, 'filename': filename})
+    
     try:
         data = request.get_json()
         photo_data = data['photo_data']
@@ -276,7 +817,7 @@ def save_photo():
         filename = f"{firstname}_{lastname}.jpg"
         
         # Save to static/images folder
-        filepath = os.path.join(app.root_path, 'static', 'images', filename)
+        filepath = os.path.join(current_app.root_path, 'static', 'images', filename)
         with open(filepath, 'wb') as f:
             f.write(photo_binary)
         
@@ -285,10 +826,25 @@ def save_photo():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-@app.route('/api/save-qrcode', methods=['POST'])
+@bp.route('/api/save-qrcode', methods=['POST'])
 @login_required
 def save_qrcode():
     """Save generated QR code to static/qrcode folder"""
+    if request.files:
+        # Multipart upload, streamed to disk
+        if request.content_length and request.content_length > MAX_IMAGE_REQUEST_BYTES:
+            return jsonify({'success': False, 'error': 'QR code image is too large'}), 413
+        stream = image_upload_stream('qrcode')
+        idno = secure_filename(request.form.get('idno', ''))
+        if stream is None or not idno:
+            return jsonify({'success': False, 'error': 'qrcode file and idno are required'}), 400
+        filename = f"qrcode_{idno}.png"
+        try:
+            save_static_image(stream, 'qrcode', filename)
+        except photostore.PhotoRejected as e:
+            return image_upload_error(e)
+        return jsonify({'success': True, 'filename': filename})
+    
     try:
         data = request.get_json()
         qrcode_data = data['qrcode_data']
@@ -302,7 +858,7 @@ def save_qrcode():
         filename = f"qrcode_{idno}.png"
         
         # Save to static/qrcode folder
-        filepath = os.path.join(app.root_path, 'static', 'qrcode', filename)
+        filepath = os.path.join(current_app.root_path, 'static', 'qrcode', filename)
         with open(filepath, 'wb') as f:
             f.write(qrcode_binary)
         
@@ -311,7 +867,7 @@ def save_qrcode():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-@app.route('/api/attendance', methods=['POST'])
+@bp.route('/api/attendance', methods=['POST'])
 def record_attendance_api():
     """Record attendance via QR code scan"""
     data = request.get_json()
@@ -331,8 +887,61 @@ def record_attendance_api():
         return jsonify({'success': True, 'message': 'MARKED AS PRESENT!', 'already_present': False})
     elif result['already_present']:
         return jsonify({'success': True, 'message': 'ALREADY MARKED AS PRESENT TODAY', 'already_present': True})
+    elif result.get('busy'):
+        return jsonify({'success': False, 'message': 'SERVER BUSY, PLEASE SCAN AGAIN'}), 503
     else:
         return jsonify({'success': False, 'message': 'Error recording attendance'}), 500
 
+@bp.route('/api/attendance/batch', methods=['POST'])
+def record_attendance_batch_api():
+    """Record scans a kiosk queued while it was offline"""
+    data = request.get_json(silent=True) or {}
+    events = data.get('events')
+    
+    if not isinstance(events, list) or not events:
+        return jsonify({'success': False, 'message': 'No scan events'}), 400
+    if len(events) > MAX_BATCH_EVENTS:
+        return jsonify({'success': False, 'message': f'At most {MAX_BATCH_EVENTS} events per batch'}), 413
+    
+    try:
+        results = record_attendance_batch(events)
+    except sqlite3.Error:
+        current_app.logger.exception('Error recording attendance batch')
+        return jsonify({'success': False, 'message': 'Error recording attendance'}), 503
+    
+    return jsonify({'success': True, 'results': results})
+
+@bp.route('/api/scan-attendance', methods=['POST'])
+def scan_attendance():
+    """Look up a scanned QR code and mark attendance in one request"""
+    data = request.get_json(silent=True) or {}
+    idno = data.get('idno')
+    
+    if not idno:
+        return jsonify({'success': False, 'message': 'Invalid QR code'}), 400
+    
+    student, result = mark_attendance_by_idno(idno)
+    
+    if not student:
+        return jsonify({'success': False, 'message': 'Student not found'}), 404
+    
+    response = {
+        'success': True,
+        'student': student_card(student),
+        'photo_url': photo_url(student)
+    }
+    if result['recorded']:
+        response.update(message='MARKED AS PRESENT!', already_present=False)
+    elif result['already_present']:
+        response.update(message='ALREADY MARKED AS PRESENT TODAY', already_present=True)
+    elif result.get('busy'):
+        response.update(success=False, message='SERVER BUSY, PLEASE SCAN AGAIN')
+        return jsonify(response), 503
+    else:
+        response.update(success=False, message='Error recording attendance')
+        return jsonify(response), 500
+    return jsonify(response)
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server with the debugger; serve.py is for production
+    create_app().run(debug=True)
@@ -0,0 +1,127 @@
+"""Build a synthetic school database at realistic scale
+
+    python -m bench.generate --db /tmp/bench/school.db --students 100000 --days 120
+
+Creates (or extends) the database at --db with --students students and
+attendance for the last --days weekdays before today, each student present
+with probability --attendance-rate at a time between 07:00 and 09:30.
+Photos are JPEG-shaped blobs of realistic size; --photo-pool distinct ones
+are shared among the students, so disk use stays at pool x size while every
+student still has a photo to serve. An admin user is added for the load
+test. The same --seed always produces the same data. Prints one JSON object.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from db import connection, photostore
+
+COURSES = ('BSIT', 'BSCS', 'BSCPE', 'BSE')
+FIRST_NAMES = ('Juan', 'Maria', 'Jose', 'Ana', 'Pedro', 'Rosa', 'Carlo', 'Liza', 'Mark', 'Joy',
+               'Paolo', 'Grace', 'Miguel', 'Angel', 'Ramon', 'Kristine', 'Noel', 'Camille')
+LAST_NAMES = ('Santos', 'Reyes', 'Cruz', 'Bautista', 'Ocampo', 'Garcia', 'Mendoza', 'Torres',
+              'Villanueva', 'Ramos', 'Aquino', 'Castillo', 'Flores', 'Gonzales', 'Dela Cruz')
+FIRST_IDNO = 20000000
+
+
+def fake_photo(rng, mean_kb):
+    """Random bytes framed as a JPEG, sized around mean_kb"""
+    size = max(2048, int(rng.gauss(mean_kb, mean_kb / 4) * 1024))
+    return b'\xff\xd8\xff\xe0' + rng.randbytes(size - 6) + b'\xff\xd9'
+
+
+def school_days(count, before):
+    """The last count weekdays before the given date, oldest first"""
+    days = []
+    day = before
+    while len(days) < count:
+        day -= timedelta(days=1)
+        if day.weekday() < 5:
+            days.append(day)
+    return days[::-1]
+
+
+def generate_students(db, rng, args):
+    photo_hashes = [photostore.put(fake_photo(rng, args.photo_kb)) for _ in range(args.photo_pool)]
+    start = FIRST_IDNO + db.execute('SELECT COUNT(*) FROM students').fetchone()[0]
+    for offset in range(0, args.students, args.chunk):
+        rows = []
+        for n in range(start + offset, start + min(offset + args.chunk, args.students)):
+            rows.append((str(n), rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.choice(COURSES),
+                         str(rng.randint(1, 4)), rng.choice(photo_hashes)))
+        db.executemany('INSERT OR IGNORE INTO students (idno, firstname, lastname, course, level, photo_hash) '
+                       'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        db.commit()
+
+
+def generate_attendance(db, rng, args):
+    student_ids = [row[0] for row in db.execute('SELECT id FROM students')]
+    total = 0
+    for day in school_days(args.days, datetime.utcnow() + timedelta(hours=8)):
+        date = day.strftime('%Y-%m-%d')
+        rows = []
+        for student_id in student_ids:
+            if rng.random() < args.attendance_rate:
+                seconds = rng.randint(7 * 3600, 9 * 3600 + 1800)
+                rows.append((student_id, f'{date} {seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}', date))
+        # Arrival order, so ids grow with time_in as they do in production
+        rows.sort(key=lambda row: row[1])
+        db.executemany('INSERT INTO attendance (student_id, time_in, date) VALUES (?, ?, ?) '
+                       'ON CONFLICT (student_id, date) DO NOTHING', rows)
+        db.commit()
+        total += len(rows)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help='database file to create or extend')
+    parser.add_argument('--photos', help='photo store directory (default: photos/ next to --db)')
+    parser.add_argument('--students', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=120, help='school days of attendance history')
+    parser.add_argument('--attendance-rate', type=float, default=0.9)
+    parser.add_argument('--photo-kb', type=float, default=60, help='mean photo size in KB')
+    parser.add_argument('--photo-pool', type=int, default=200, help='distinct photos to share out')
+    parser.add_argument('--chunk', type=int, default=5000, help='rows per transaction')
+    parser.add_argument('--admin-email', default='bench@example.com')
+    parser.add_argument('--admin-password', default='bench')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.db)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection.configure(database=path)
+    photostore.configure(args.photos or os.path.join(os.path.dirname(path), 'photos'))
+    from db import dbhelper
+    from db.migrations import run_migrations
+    run_migrations()
+    rng = random.Random(args.seed)
+
+    started = time.perf_counter()
+    with connection.connection() as db:
+        generate_students(db, rng, args)
+        students_done = time.perf_counter()
+        rows = generate_attendance(db, rng, args)
+    attendance_done = time.perf_counter()
+    dbhelper.create_user(args.admin_email, args.admin_password, 'Benchmark Admin')
+
+    print(json.dumps({
+        'benchmark': 'generate',
+        'database': path,
+        'photo_dir': photostore.PHOTO_DIR,
+        'seed': args.seed,
+        'students': args.students,
+        'attendance_rows': rows,
+        'seconds': {
+            'students': round(students_done - started, 2),
+            'attendance': round(attendance_done - students_done, 2),
+        },
+        'database_mb': round(os.path.getsize(path) / 1024 / 1024, 1),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Attendance insert throughput: per-request commit vs group commit
+
+    python -m bench.group_commit --threads 32 --scans 100 --durability full
+
+Each mode gets a fresh temporary database with threads * scans students.
+Every thread records attendance for its own students through
+record_attendance(), so every call inserts a row. Prints one JSON object;
+speedup is left out, and the exit status is 1, if any scan was not recorded.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from bench.stats import latency_summary
+from db import connection
+from db.writer import DURABILITY
+
+
+def setup_database(path, students):
+    from db.migrations import run_migrations
+    run_migrations()
+    with connection.connection() as db:
+        db.executemany(
+            'INSERT INTO students (idno, firstname, lastname, course, level) VALUES (?, ?, ?, ?, ?)',
+            [(str(100000 + n), 'Bench', f'Student{n}', 'BSIT', '1') for n in range(students)])
+        db.commit()
+
+
+def run_mode(mode, args):
+    from db import dbhelper
+    workdir = tempfile.mkdtemp(prefix='bench-group-commit-')
+    path = os.path.join(workdir, 'school.db')
+    connection.configure(database=path, pool_size=args.threads + 2,
+                         synchronous=DURABILITY[args.durability])
+    setup_database(path, args.threads * args.scans)
+    if mode == 'group':
+        dbhelper.start_attendance_writer(max_batch=args.max_batch,
+                                         max_delay=args.max_delay_ms / 1000,
+                                         queue_size=args.threads * 4,
+                                         durability=args.durability,
+                                         submit_timeout=30)
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+
+    def kiosk(worker):
+        mine = []
+        failed = 0
+        barrier.wait()
+        for n in range(args.scans):
+            student_id = worker * args.scans + n + 1
+            started = time.perf_counter()
+            result = dbhelper.record_attendance(student_id)
+            mine.append(time.perf_counter() - started)
+            if not result['recorded']:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=kiosk, args=(w,)) for w in range(args.threads)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    result = {
+        'mode': mode,
+        'scans': len(latencies),
+        'errors': sum(errors),
+        'seconds': round(elapsed, 4),
+        'throughput_per_s': round(len(latencies) / elapsed, 1),
+        'latency_ms': latency_summary(latencies),
+    }
+    if mode == 'group':
+        writer = dbhelper._attendance_writer
+        result['commits'] = writer.batches
+        result['rows_per_commit'] = round(writer.rows / max(writer.batches, 1), 1)
+        dbhelper.stop_attendance_writer()
+    connection.configure()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16, help='concurrent kiosks')
+    parser.add_argument('--scans', type=int, default=100, help='scans per kiosk')
+    parser.add_argument('--durability', choices=sorted(DURABILITY), default='full')
+    parser.add_argument('--max-batch', type=int, default=200)
+    parser.add_argument('--max-delay-ms', type=float, default=5)
+    parser.add_argument('--modes', default='direct,group')
+    args = parser.parse_args()
+
+    results = [run_mode(mode, args) for mode in args.modes.split(',')]
+    report = {
+        'benchmark': 'group_commit',
+        'threads': args.threads,
+        'scans_per_thread': args.scans,
+        'durability': args.durability,
+        'results': results,
+    }
+    failed = any(result['errors'] for result in results)
+    if len(results) == 2 and not failed:
+        report['speedup'] = round(results[1]['throughput_per_s'] / results[0]['throughput_per_s'], 2)
+    print(json.dumps(report, indent=2))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Load test the scan path and admin pages of a running server
+
+    python -m bench.loadtest --db /tmp/bench/school.db --serve --kiosks 32 --admins 2 --duration 30
+
+Each kiosk thread loops over random students from --db, posting each to
+/api/scan-attendance as the kiosk page does. Each admin thread logs in
+and cycles through --admin-pages (by default /admin/students and
+/admin/attendance; add /admin/attendance/export for export load). With
+--serve the app is started on --port against --db (and the photos/ next
+to it); otherwise --url must point at a server already using that database.
+Prints one JSON object (also written to --output) with throughput and
+p50/p95/p99 latency per endpoint, tagged with the current git commit.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from bench.stats import latency_summary
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Recorder:
+    """Latencies and failures per endpoint, shared by all client threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def request(self, name, opener, url, data=None, headers=None, timeout=30):
+        request = urllib.request.Request(url, data=data, headers=headers or {})
+        started = time.perf_counter()
+        try:
+            with opener.open(request, timeout=timeout) as response:
+                response.read()
+                failed = False
+        except urllib.error.HTTPError as e:
+            e.read()
+            failed = e.code >= 500
+        except OSError:
+            failed = True
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            self.errors[name] = self.errors.get(name, 0) + failed
+
+
+def load_idnos(path):
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return [row[0] for row in db.execute('SELECT idno FROM students')]
+    finally:
+        db.close()
+
+
+def kiosk(args, idnos, recorder, seed, stop_at):
+    rng = random.Random(seed)
+    opener = urllib.request.build_opener()
+    while time.perf_counter() < stop_at:
+        idno = rng.choice(idnos)
+        recorder.request('POST /api/scan-attendance', opener, f'{args.url}/api/scan-attendance',
+                         data=json.dumps({'idno': idno}).encode(),
+                         headers={'Content-Type': 'application/json'})
+        if args.think_ms:
+            time.sleep(args.think_ms / 1000)
+
+
+def admin(args, recorder, stop_at):
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    form = urllib.parse.urlencode({'email': args.admin_email, 'password': args.admin_password}).encode()
+    opener.open(f'{args.url}/admin/login', data=form, timeout=30).read()
+    if not any(cookie.name == 'session' for cookie in jar):
+        raise SystemExit('admin login failed; run bench.generate or pass --admin-email/--admin-password')
+    pages = args.admin_pages.split(',')
+    n = 0
+    while time.perf_counter() < stop_at:
+        page = pages[n % len(pages)]
+        recorder.request('GET ' + page, opener, args.url + page)
+        n += 1
+
+
+def start_server(args):
+    """Run the app in a child process against --db and wait until it answers"""
+    env = dict(os.environ,
+               SCHOOL_DB=os.path.abspath(args.db),
+               SCHOOL_PHOTO_DIR=os.path.join(os.path.dirname(os.path.abspath(args.db)), 'photos'))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(args.port), '--with-threads'],
+        cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'{args.url}/', timeout=1).read()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise SystemExit('server exited during startup')
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit('server did not start within 60s')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help='database the server uses (students are read from it)')
+    parser.add_argument('--url', help='server to test (default: http://127.0.0.1:PORT)')
+    parser.add_argument('--serve', action='store_true', help='start the app for the run')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--kiosks', type=int, default=16)
+    parser.add_argument('--admins', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--think-ms', type=float, default=0, help='pause between a kiosk\'s scans')
+    parser.add_argument('--admin-pages', default='/admin/students,/admin/attendance',
+                        help='comma-separated pages each admin thread cycles through')
+    parser.add_argument('--admin-email', default='bench@example.com')
+    parser.add_argument('--admin-password', default='bench')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the JSON report here')
+    args = parser.parse_args()
+    args.url = (args.url or f'http://127.0.0.1:{args.port}').rstrip('/')
+
+    idnos = load_idnos(args.db)
+    if not idnos:
+        raise SystemExit('no students in --db; run bench.generate first')
+    server = start_server(args) if args.serve else None
+    try:
+        recorder = Recorder()
+        stop_at = time.perf_counter() + args.duration
+        threads = [threading.Thread(target=kiosk, args=(args, idnos, recorder, args.seed + n, stop_at))
+                   for n in range(args.kiosks)]
+        threads += [threading.Thread(target=admin, args=(args, recorder, stop_at)) for _ in range(args.admins)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    endpoints = {}
+    for name, latencies in sorted(recorder.latencies.items()):
+        endpoints[name] = {
+            'requests': len(latencies),
+            'errors': recorder.errors[name],
+            'throughput_per_s': round(len(latencies) / elapsed, 1),
+            'latency_ms': latency_summary(latencies),
+        }
+    total = sum(endpoint['requests'] for endpoint in endpoints.values())
+    report = {
+        'benchmark': 'loadtest',
+        'commit': git_commit(),
+        'url': args.url,
+        'students': len(idnos),
+        'kiosks': args.kiosks,
+        'admins': args.admins,
+        'admin_pages': args.admin_pages.split(','),
+        'seconds': round(elapsed, 2),
+        'requests': total,
+        'errors': sum(endpoint['errors'] for endpoint in endpoints.values()),
+        'throughput_per_s': round(total / elapsed, 1),
+        'endpoints': endpoints,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
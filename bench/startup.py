@@ -0,0 +1,140 @@
+"""Cold start and first-request latency of the server
+
+    python -m bench.startup --db /tmp/bench/school.db --runs 5 --workers 2
+
+Each run starts serve.py in a fresh interpreter against --db, measures how
+long it takes until the kiosk page (/) answers, then times the first and a
+repeat request to the login page and to one scan. Importing the app and
+create_app() are also timed on their own, in a fresh interpreter each run. Prints one JSON object (also written to --output),
+tagged with the current git commit.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from bench.loadtest import REPO_ROOT, git_commit
+from bench.stats import latency_summary
+
+# Timed in a fresh interpreter: importing the app, then building and warming it
+IMPORT_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+print(json.dumps({'import': imported - started, 'create_app': time.perf_counter() - imported}))
+"""
+
+
+def server_env(db):
+    return dict(os.environ,
+                SCHOOL_DB=os.path.abspath(db),
+                SCHOOL_PHOTO_DIR=os.path.join(os.path.dirname(os.path.abspath(db)), 'photos'))
+
+
+def first_idno(path):
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        row = db.execute('SELECT idno FROM students ORDER BY id LIMIT 1').fetchone()
+        return row[0] if row else None
+    finally:
+        db.close()
+
+
+def timed_get(url):
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            response.read()
+    except urllib.error.HTTPError as e:
+        e.read()
+    return time.perf_counter() - started
+
+
+def measure_import(args):
+    result = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=REPO_ROOT, env=server_env(args.db),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure_server(args, pages):
+    url = f'http://127.0.0.1:{args.port}'
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, 'serve.py', '--port', str(args.port), '--workers', str(args.workers)],
+        cwd=REPO_ROOT, env=server_env(args.db), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                urllib.request.urlopen(f'{url}/', timeout=1).read()
+                break
+            except OSError:
+                if server.poll() is not None:
+                    raise SystemExit('server exited during startup')
+                if time.monotonic() > deadline:
+                    raise SystemExit('server did not start within 60s')
+                time.sleep(0.01)
+        ready = time.perf_counter() - started
+        first = {page: timed_get(url + page) for page in pages}
+        repeat = {page: timed_get(url + page) for page in pages}
+    finally:
+        server.terminate()
+        server.wait()
+    return ready, first, repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help='database the server uses')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--port', type=int, default=5098)
+    parser.add_argument('--output', help='also write the JSON report here')
+    args = parser.parse_args()
+
+    pages = ['/admin/login']
+    idno = first_idno(args.db)
+    if idno:
+        pages.append('/api/scan/' + urllib.parse.quote(idno))
+
+    imports, create_apps, readies = [], [], []
+    firsts = {page: [] for page in pages}
+    repeats = {page: [] for page in pages}
+    for _ in range(args.runs):
+        timings = measure_import(args)
+        imports.append(timings['import'])
+        create_apps.append(timings['create_app'])
+        ready, first, repeat = measure_server(args, pages)
+        readies.append(ready)
+        for page in pages:
+            firsts[page].append(first[page])
+            repeats[page].append(repeat[page])
+
+    report = {
+        'benchmark': 'startup',
+        'commit': git_commit(),
+        'runs': args.runs,
+        'workers': args.workers,
+        'import_ms': latency_summary(imports),
+        'create_app_ms': latency_summary(create_apps),
+        'ready_ms': latency_summary(readies),
+        'first_request_ms': {page: latency_summary(values) for page, values in firsts.items()},
+        'repeat_request_ms': {page: latency_summary(values) for page, values in repeats.items()},
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+import statistics
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(seconds):
+    """Mean and p50/p95/p99 of a list of durations in seconds, as milliseconds"""
+    if not seconds:
+        return {'mean': None, 'p50': None, 'p95': None, 'p99': None}
+    return {
+        'mean': round(statistics.mean(seconds) * 1000, 3),
+        'p50': round(percentile(seconds, 0.50) * 1000, 3),
+        'p95': round(percentile(seconds, 0.95) * 1000, 3),
+        'p99': round(percentile(seconds, 0.99) * 1000, 3),
+    }
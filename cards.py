@@ -0,0 +1,280 @@
+import base64
+import hashlib
+import html
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import qr
+from db import photostore
+from db.metrics import registry
+
+# Batch QR codes and printable ID-card sheets. Every rendered file is cached
+# under CACHE_DIR by (IDNO, hash of everything drawn into it), so a student
+# whose details have not changed is never rendered twice; misses are spread
+# over a process pool. build_zip() streams the results as a zip archive.
+
+CACHE_DIR = os.environ.get('SCHOOL_CARD_CACHE', os.path.join(os.path.dirname(__file__), 'db', 'card_cache'))
+# Bump to invalidate every cached file after a change to the drawing code
+RENDER_VERSION = 1
+QR_SCALE = 8
+QR_BORDER = 4
+# Students per pool task, and the most misses worth rendering in-process
+CHUNK_SIZE = 50
+INLINE_LIMIT = 20
+WORKERS = int(os.environ.get('CARD_WORKERS', 0)) or os.cpu_count() or 2
+
+# ID-1 (CR80) cards on an A4 sheet, in millimetres
+CARD_WIDTH, CARD_HEIGHT = 85.6, 54.0
+SHEET_WIDTH, SHEET_HEIGHT = 210.0, 297.0
+SHEET_COLUMNS, SHEET_ROWS = 2, 5
+CARDS_PER_SHEET = SHEET_COLUMNS * SHEET_ROWS
+
+registry.describe('card_renders_total', 'QR code and ID-card files rendered or served from the cache')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure(cache_dir):
+    """Point the cache at another directory"""
+    global CACHE_DIR
+    CACHE_DIR = cache_dir
+
+
+def _pool_executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the server has pool, writer and SSE threads
+            # whose locks a forked child could inherit mid-use
+            _pool = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def shutdown_pool():
+    """Stop the worker processes, if any were started"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+# Cache layout: CACHE_DIR/<sha256 of IDNO, 32 hex>/<content hash>.<ext>.
+# Writing a new version of a file removes the student's older ones.
+
+def _student_dir(cache_dir, idno):
+    return os.path.join(cache_dir, hashlib.sha256(idno.encode('utf-8')).hexdigest()[:32])
+
+
+def _content_hash(kind, fields):
+    data = json.dumps([RENDER_VERSION, kind, fields], sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:32]
+
+
+def cache_path(cache_dir, idno, digest, extension):
+    return os.path.join(_student_dir(cache_dir, idno), f'{digest}.{extension}')
+
+
+def _store(cache_dir, idno, digest, extension, data):
+    directory = _student_dir(cache_dir, idno)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, os.path.join(directory, f'{digest}.{extension}'))
+    for name in os.listdir(directory):
+        if name.endswith('.' + extension) and name != f'{digest}.{extension}':
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+# Work items are plain tuples so they pickle cheaply to the workers:
+# (kind, idno, digest, fields). Cards embed the photo from the photo store.
+
+def _work_items(student, cards):
+    idno = student['idno']
+    qr_fields = {'idno': idno, 'scale': QR_SCALE, 'border': QR_BORDER}
+    items = [('qr', idno, _content_hash('qr', qr_fields), qr_fields)]
+    if cards:
+        card_fields = {
+            'idno': idno,
+            'name': f"{student['firstname']} {student['lastname']}",
+            'course': student['course'],
+            'level': student['level'],
+            'photo_hash': student['photo_hash'],
+        }
+        items.append(('card', idno, _content_hash('card', card_fields), card_fields))
+    return items
+
+
+def _photo_href(photo_hash, photo_dir):
+    if not photo_hash:
+        return None
+    try:
+        with open(os.path.join(photo_dir, photo_hash[:2], photo_hash), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    kind = photostore.image_type(data[:8])
+    if kind is None:
+        return None
+    return f'data:{kind};base64,{base64.b64encode(data).decode("ascii")}'
+
+
+def render_card(fields, photo_dir, modules):
+    """One card as an SVG <g> fragment, in millimetres from its top-left corner"""
+    qr_size = len(modules) + 2 * QR_BORDER
+    photo = _photo_href(fields['photo_hash'], photo_dir)
+    if photo:
+        picture = (f'<image x="4" y="9" width="24" height="30" preserveAspectRatio="xMidYMid slice" '
+                   f'href="{photo}"/>')
+    else:
+        picture = '<rect x="4" y="9" width="24" height="30" fill="#ccc"/>'
+    return (
+        f'<rect width="{CARD_WIDTH}" height="{CARD_HEIGHT}" rx="3" fill="#fff" stroke="#999" stroke-width="0.2"/>'
+        f'<rect width="{CARD_WIDTH}" height="6" fill="#373a36"/>'
+        f'<text x="{CARD_WIDTH / 2}" y="4.3" font-size="3" fill="#fff" text-anchor="middle">STUDENT ID</text>'
+        f'{picture}'
+        f'<text x="31" y="14" font-size="3.6" font-weight="bold">{html.escape(fields["name"])}</text>'
+        f'<text x="31" y="20" font-size="3">{html.escape(fields["idno"])}</text>'
+        f'<text x="31" y="25" font-size="3">{html.escape(fields["course"])} - {html.escape(str(fields["level"]))}</text>'
+        f'<svg x="56" y="24" width="27" height="27" viewBox="0 0 {qr_size} {qr_size}" shape-rendering="crispEdges">'
+        f'<rect width="{qr_size}" height="{qr_size}" fill="#fff"/>'
+        f'<path d="{qr.svg_path(modules, QR_BORDER)}"/></svg>'
+    )
+
+
+def _render_chunk(cache_dir, photo_dir, items):
+    """Render work items into the cache; runs in a pool worker"""
+    # A student's PNG and card share one encoding
+    encoded = {}
+    for kind, idno, digest, fields in items:
+        if idno not in encoded:
+            encoded[idno] = qr.encode(idno)
+        if kind == 'qr':
+            data = qr.png(encoded[idno], fields['scale'], fields['border'])
+            _store(cache_dir, idno, digest, 'png', data)
+        else:
+            _store(cache_dir, idno, digest, 'svg', render_card(fields, photo_dir, encoded[idno]).encode('utf-8'))
+    return len(items)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _extension(kind):
+    return 'png' if kind == 'qr' else 'svg'
+
+
+def _safe_name(idno):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in idno)
+
+
+class _ZipOutput:
+    """Write-only file object that collects what zipfile writes
+
+    It has no tell() or seek(), so zipfile writes entries with data
+    descriptors and the archive can be sent while it is being built.
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def _sheet(fragments):
+    cards = []
+    left = (SHEET_WIDTH - SHEET_COLUMNS * CARD_WIDTH) / 2
+    top = (SHEET_HEIGHT - SHEET_ROWS * CARD_HEIGHT) / 2
+    for n, fragment in enumerate(fragments):
+        x = left + n % SHEET_COLUMNS * CARD_WIDTH
+        y = top + n // SHEET_COLUMNS * CARD_HEIGHT
+        cards.append(f'<g transform="translate({x:.1f} {y:.1f})">{fragment}</g>')
+    return ('<svg xmlns="http://www.w3.org/2000/svg" '
+            f'width="{SHEET_WIDTH}mm" height="{SHEET_HEIGHT}mm" viewBox="0 0 {SHEET_WIDTH} {SHEET_HEIGHT}" '
+            'font-family="Arial, Helvetica, sans-serif">' + ''.join(cards) + '</svg>').encode('utf-8')
+
+
+def zip_name(course=None, level=None, cards=False):
+    """Download name for a batch, e.g. id_cards_BSIT_2.zip"""
+    return f"{'id_cards' if cards else 'qrcodes'}_{_safe_name(course or 'all')}{'_' + _safe_name(level) if level else ''}.zip"
+
+
+def build_zip(students, cards=False):
+    """Yield a zip archive of QR code PNGs, plus A4 card sheets if cards is set
+
+    students is a list of student records in the order wanted. Misses are
+    submitted to the pool in chunks up front, then the archive is written
+    chunk by chunk as each one finishes, so the download starts as soon as
+    the first students are ready.
+    """
+    cache_dir, photo_dir = CACHE_DIR, photostore.PHOTO_DIR
+    groups = []
+    misses = 0
+    for chunk in _chunks(students, CHUNK_SIZE):
+        items = [item for student in chunk for item in _work_items(student, cards)]
+        missing = [item for item in items
+                   if not os.path.exists(cache_path(cache_dir, item[1], item[2], _extension(item[0])))]
+        misses += len(missing)
+        groups.append((items, missing))
+        registry.inc('card_renders_total', len(items) - len(missing), result='cached')
+        registry.inc('card_renders_total', len(missing), result='rendered')
+
+    pool = _pool_executor() if misses > INLINE_LIMIT else None
+    pending = []
+    for items, missing in groups:
+        if missing and pool is not None:
+            pending.append((items, pool.submit(_render_chunk, cache_dir, photo_dir, missing)))
+        else:
+            if missing:
+                _render_chunk(cache_dir, photo_dir, missing)
+            pending.append((items, None))
+
+    output = _ZipOutput()
+    stamp = time.localtime()[:6]
+    fragments = []
+    sheets = 0
+    with zipfile.ZipFile(output, 'w') as archive:
+        for items, future in pending:
+            if future is not None:
+                future.result()
+            for kind, idno, digest, _ in items:
+                with open(cache_path(cache_dir, idno, digest, _extension(kind)), 'rb') as f:
+                    data = f.read()
+                if kind == 'qr':
+                    name = f'qrcodes/qrcode_{_safe_name(idno)}.png'
+                    archive.writestr(zipfile.ZipInfo(name, stamp), data, zipfile.ZIP_STORED)
+                else:
+                    fragments.append(data.decode('utf-8'))
+                    if len(fragments) == CARDS_PER_SHEET:
+                        sheets += 1
+                        archive.writestr(zipfile.ZipInfo(f'cards/sheet_{sheets:03d}.svg', stamp),
+                                         _sheet(fragments), zipfile.ZIP_DEFLATED)
+                        fragments = []
+            yield output.take()
+        if fragments:
+            sheets += 1
+            archive.writestr(zipfile.ZipInfo(f'cards/sheet_{sheets:03d}.svg', stamp), _sheet(fragments), zipfile.ZIP_DEFLATED)
+    yield output.take()
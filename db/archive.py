@@ -0,0 +1,315 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from db import connection
+
+log = logging.getLogger(__name__)
+
+# Attendance archival. A closed term's attendance rows are moved out of the
+# live attendance table into a SQLite file of their own, together with a
+# snapshot of the students they belong to, so the table (and the indexes
+# every scan touches) only holds the current term.
+#
+# archived_terms in the live database records each term and how far the
+# move has got: every row with an id up to moved_through has been copied to
+# the archive and deleted from the live table, in that order and in chunks,
+# so an interrupted move resumes where it stopped and readers can tell which
+# archive rows are authoritative (see read_with_archives).
+#
+# attendance_daily keeps its counts for archived days: the delete trigger is
+# skipped while the 'archiving' maintenance flag is set, which only the
+# archiver's own transaction ever sees.
+
+ARCHIVE_DIR = os.environ.get('SCHOOL_ARCHIVE_DIR')
+CHUNK_SIZE = 2000
+# Pause between chunks so kiosk writes get the write lock in between
+CHUNK_PAUSE = 0.05
+# SQLite attaches at most 10 databases to a connection
+MAX_ATTACHED = 10
+TERM_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')
+
+ARCHIVE_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS attendance (
+        id INTEGER PRIMARY KEY,
+        student_id INTEGER NOT NULL,
+        time_in TIMESTAMP,
+        date DATE
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ux_attendance_student_date ON attendance (student_id, date)',
+    'CREATE INDEX IF NOT EXISTS ix_attendance_time_in ON attendance (time_in)',
+    '''CREATE TABLE IF NOT EXISTS students (
+        id INTEGER PRIMARY KEY,
+        idno TEXT NOT NULL,
+        firstname TEXT NOT NULL,
+        lastname TEXT NOT NULL,
+        course TEXT NOT NULL,
+        level TEXT NOT NULL
+    )''',
+)
+
+# Rows are taken in id order; the unary + keeps SQLite walking the rowid
+# from the cursor instead of sorting the whole term out of the date index
+NEXT_CHUNK_SQL = """
+    SELECT id, student_id, time_in, date FROM attendance
+    WHERE id > ? AND +date BETWEEN ? AND ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+OVERLAPPING_TERMS_SQL = """
+    SELECT name, filename, moved_through FROM archived_terms
+    WHERE first_date <= ? AND last_date >= ? AND moved_through > 0
+    ORDER BY first_date
+"""
+
+class ArchiveError(ValueError):
+    """A term that cannot be archived, or a range spanning too many archives"""
+
+
+def configure(archive_dir):
+    """Keep archive files in another directory"""
+    global ARCHIVE_DIR
+    ARCHIVE_DIR = archive_dir
+
+
+def archive_dir():
+    """Directory of the archive files (default: archive/ next to the database)"""
+    return ARCHIVE_DIR or os.path.join(os.path.dirname(os.path.abspath(connection.DATABASE)), 'archive')
+
+
+def _open_archive(filename):
+    # Default rollback journal with synchronous=FULL: an archive commit is on
+    # disk before the live delete that depends on it
+    os.makedirs(archive_dir(), exist_ok=True)
+    archive = sqlite3.connect(os.path.join(archive_dir(), filename))
+    for statement in ARCHIVE_SCHEMA:
+        archive.execute(statement)
+    archive.commit()
+    return archive
+
+
+def list_terms():
+    """Every archived (or archiving) term, oldest first"""
+    with connection.connection() as db:
+        return [dict(row) for row in db.execute(
+            'SELECT name, first_date, last_date, filename, moved_through, row_count, status, started_at, finished_at '
+            'FROM archived_terms ORDER BY first_date')]
+
+
+def register_term(name, first_date, last_date, today):
+    """Record a term to archive; registering the same term again changes nothing
+
+    The term must have ended before today and must not overlap another
+    archived term. Raises ArchiveError otherwise.
+    """
+    if not TERM_NAME.match(name or ''):
+        raise ArchiveError('term name may only use letters, digits, ".", "_" and "-"')
+    if first_date > last_date:
+        raise ArchiveError('the term must not end before it starts')
+    if last_date >= today:
+        raise ArchiveError('only terms that have ended can be archived')
+    with connection.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            existing = db.execute('SELECT first_date, last_date FROM archived_terms WHERE name = ?',
+                                  (name,)).fetchone()
+            if existing is not None:
+                if tuple(existing) != (first_date, last_date):
+                    raise ArchiveError(f'term {name} was archived with different dates')
+            else:
+                clash = db.execute('SELECT name FROM archived_terms WHERE first_date <= ? AND last_date >= ?',
+                                   (last_date, first_date)).fetchone()
+                if clash is not None:
+                    raise ArchiveError(f'dates overlap archived term {clash[0]}')
+                db.execute('INSERT INTO archived_terms (name, first_date, last_date, filename) VALUES (?, ?, ?, ?)',
+                           (name, first_date, last_date, f'attendance_{name}.db'))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+
+def _move_chunk(db, archive, term, chunk_size):
+    """Move the next chunk of a term; returns the number of rows moved, 0 when done"""
+    # The live write lock is taken first, so the chunk and its student
+    # snapshot cannot change before they are deleted
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        moved_through = db.execute('SELECT moved_through FROM archived_terms WHERE name = ?',
+                                   (term['name'],)).fetchone()[0]
+        rows = db.execute(NEXT_CHUNK_SQL, (moved_through, term['first_date'], term['last_date'],
+                                           chunk_size)).fetchall()
+        if not rows:
+            db.rollback()
+            return 0
+        ids = json.dumps([row['id'] for row in rows])
+        students = db.execute(
+            'SELECT id, idno, firstname, lastname, course, level FROM students '
+            'WHERE id IN (SELECT DISTINCT value FROM json_each(?))',
+            (json.dumps([row['student_id'] for row in rows]),)).fetchall()
+
+        archive.executemany('INSERT OR REPLACE INTO students (id, idno, firstname, lastname, course, level) '
+                            'VALUES (?, ?, ?, ?, ?, ?)', [tuple(student) for student in students])
+        archive.executemany('INSERT OR IGNORE INTO attendance (id, student_id, time_in, date) VALUES (?, ?, ?, ?)',
+                            [tuple(row) for row in rows])
+        copied = archive.execute('SELECT COUNT(*) FROM attendance WHERE id IN (SELECT value FROM json_each(?))',
+                                 (ids,)).fetchone()[0]
+        if copied != len(rows):
+            archive.rollback()
+            raise RuntimeError(f"archive of term {term['name']} has other rows for the same students and dates")
+        # Durable in the archive before they leave the live table
+        archive.commit()
+
+        db.execute("INSERT INTO maintenance_flags (name) VALUES ('archiving')")
+        deleted = db.execute('DELETE FROM attendance WHERE id IN (SELECT value FROM json_each(?))', (ids,)).rowcount
+        db.execute("DELETE FROM maintenance_flags WHERE name = 'archiving'")
+        db.execute('UPDATE archived_terms SET moved_through = ?, row_count = row_count + ? WHERE name = ?',
+                   (rows[-1]['id'], deleted, term['name']))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(rows)
+
+
+def get_term(name):
+    """An archived term as a dict, or None"""
+    with connection.connection() as db:
+        row = db.execute('SELECT name, first_date, last_date, filename, moved_through, row_count, status '
+                         'FROM archived_terms WHERE name = ?', (name,)).fetchone()
+    return dict(row) if row is not None else None
+
+
+def archive_term(name, chunk_size=CHUNK_SIZE, progress=None):
+    """Move a registered term's attendance into its archive file
+
+    Runs to completion, a chunk per transaction; calling it again after an
+    interruption carries on from the last committed chunk. progress(moved)
+    is called after every chunk and may raise to stop the move there.
+    Returns the number of rows moved by this call.
+    """
+    term = get_term(name)
+    if term is None:
+        raise ArchiveError(f'no archived term named {name}')
+    with connection.connection() as db:
+        db.execute("UPDATE archived_terms SET status = 'running', finished_at = NULL WHERE name = ?", (name,))
+        db.commit()
+    moved = 0
+    archive = _open_archive(term['filename'])
+    try:
+        while True:
+            with connection.connection() as db:
+                count = _move_chunk(db, archive, term, chunk_size)
+            if not count:
+                break
+            moved += count
+            if progress is not None:
+                progress(moved)
+            time.sleep(CHUNK_PAUSE)
+        archive.execute('PRAGMA optimize')
+    finally:
+        archive.close()
+    with connection.connection() as db:
+        db.execute("UPDATE archived_terms SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE name = ?",
+                   (name,))
+        db.commit()
+    log.info('Archived %d attendance row(s) of term %s', moved, name)
+    return moved
+
+
+def pause_term(name):
+    """Mark a term whose move was stopped on purpose, so it is not resumed on start"""
+    with connection.connection() as db:
+        db.execute("UPDATE archived_terms SET status = 'paused' WHERE name = ? AND status = 'running'", (name,))
+        db.commit()
+
+
+def unfinished_terms():
+    """Names of the terms a previous process left half moved"""
+    with connection.connection() as db:
+        return [row[0] for row in db.execute("SELECT name FROM archived_terms WHERE status = 'running'")]
+
+
+def _attach(db, first_date, last_date):
+    terms = db.execute(OVERLAPPING_TERMS_SQL, (last_date, first_date)).fetchall()
+    if len(terms) > MAX_ATTACHED:
+        raise ArchiveError(f'the date range spans more than {MAX_ATTACHED} archived terms')
+    attached = {}
+    missing = set()
+    for n, term in enumerate(terms):
+        path = os.path.join(archive_dir(), term['filename'])
+        # ATTACH would quietly create an empty file in its place
+        if not os.path.exists(path):
+            log.error('Archive %s of term %s is missing; its rows are left out', path, term['name'])
+            missing.add(term['name'])
+            continue
+        schema = f'archive_{n}'
+        db.execute(f'ATTACH DATABASE ? AS {schema}', (path,))
+        attached[term['name']] = schema
+    return attached, missing
+
+
+def _detach(db, attached):
+    for schema in attached.values():
+        db.execute(f'DETACH DATABASE {schema}')
+
+
+@contextmanager
+def read_with_archives(db, first_date=None, last_date=None):
+    """Attach the archives a date range reaches and hold a read transaction
+
+    Yields [(schema, moved_through), ...]; a query takes the live table plus
+    <schema>.attendance WHERE id <= moved_through from each, which never
+    counts a row twice, even while a move is in progress. The archive list
+    is checked again inside the transaction, in case a move started after
+    the attach. ATTACH cannot run inside a transaction, so db must not be in
+    one.
+    """
+    first_date = first_date or '0000-01-01'
+    last_date = last_date or '9999-12-31'
+    for _ in range(3):
+        attached, missing = _attach(db, first_date, last_date)
+        db.execute('BEGIN')
+        terms = db.execute(OVERLAPPING_TERMS_SQL, (last_date, first_date)).fetchall()
+        if all(term['name'] in attached or term['name'] in missing for term in terms):
+            try:
+                yield [(attached[term['name']], term['moved_through']) for term in terms
+                       if term['name'] in attached]
+            finally:
+                db.rollback()
+                _detach(db, attached)
+            return
+        db.rollback()
+        _detach(db, attached)
+    raise RuntimeError('archived terms kept changing while attaching them')
+
+
+def archived_daily_counts(db):
+    """[(date, course, level, present), ...] per archived day, from every archive file
+
+    Grouped by the students' course and level when they were archived, as
+    attendance_daily has them. The term list is read through db, so a caller
+    holding a transaction sees the archives as of that transaction.
+    """
+    terms = db.execute('SELECT name, filename, moved_through FROM archived_terms WHERE moved_through > 0').fetchall()
+    counts = []
+    for term in terms:
+        path = os.path.join(archive_dir(), term['filename'])
+        if not os.path.exists(path):
+            log.error('Archive %s of term %s is missing; its rows are left out', path, term['name'])
+            continue
+        archive = sqlite3.connect(path)
+        try:
+            counts += archive.execute('''
+                SELECT a.date, s.course, s.level, COUNT(*) FROM attendance a
+                JOIN students s ON s.id = a.student_id
+                WHERE a.id <= ?
+                GROUP BY a.date, s.course, s.level''', (term['moved_through'],)).fetchall()
+        finally:
+            archive.close()
+    return counts
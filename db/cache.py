@@ -0,0 +1,168 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from db import connection
+
+
+class LRUCache:
+    """Thread-safe bounded LRU mapping with an optional time-to-live"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class StudentRecord:
+    """Compact, read-only student row (no photo bytes)
+
+    Supports record['field'] and dict(record) so it can stand in for the
+    sqlite3.Row the helpers used to return.
+    """
+
+    __slots__ = ('id', 'idno', 'firstname', 'lastname', 'course', 'level', 'photo_hash', 'created_at')
+
+    def __init__(self, row):
+        for name in self.__slots__:
+            object.__setattr__(self, name, row[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('StudentRecord is read-only')
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def keys(self):
+        return self.__slots__
+
+    def __repr__(self):
+        return f'StudentRecord(id={self.id!r}, idno={self.idno!r})'
+
+
+# Columns a StudentRecord is built from
+STUDENT_COLUMNS = ', '.join(StudentRecord.__slots__)
+
+
+class StudentCache:
+    """Student lookups keyed by IDNO and by id
+
+    Every lookup first checks the roster generation, a counter in the meta
+    table that triggers bump on any change to students. The counter is only
+    re-read when PRAGMA data_version says another connection has committed,
+    so with no writes the check is a single pragma call and other worker
+    processes' edits are never served stale.
+    """
+
+    def __init__(self, maxsize=20000, ttl=300):
+        self.by_idno = LRUCache(maxsize, ttl)
+        self.by_id = LRUCache(maxsize, ttl)
+        self.generation = None
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._probe = None
+        self._probe_path = None
+        self._data_version = None
+        self._roster_generation = 0
+
+    def _current_generation(self):
+        with self._lock:
+            if self._probe is None or self._probe_path != connection.DATABASE:
+                if self._probe is not None:
+                    self._probe.close()
+                self._probe = sqlite3.connect(connection.DATABASE, check_same_thread=False)
+                self._probe_path = connection.DATABASE
+                self._data_version = None
+            data_version = self._probe.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:
+                row = self._probe.execute(
+                    "SELECT value FROM meta WHERE key = 'roster_generation'").fetchone()
+                self._roster_generation = row[0] if row else 0
+                self._data_version = data_version
+            return self._roster_generation
+
+    def validate(self):
+        """Drop every entry if the roster changed since they were cached"""
+        generation = self._current_generation()
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+        return generation
+
+    def lookup(self, key, by='idno'):
+        """Return (record or None, generation); pass generation to put() after a miss"""
+        generation = self.validate()
+        index = self.by_idno if by == 'idno' else self.by_id
+        return index.get(key), generation
+
+    def put(self, record, generation):
+        """Cache a record read while the roster was at generation"""
+        if generation == self.generation:
+            self.by_idno.set(record.idno, record)
+            self.by_id.set(record.id, record)
+
+    def clear(self):
+        self.by_idno.clear()
+        self.by_id.clear()
+        self.invalidations += 1
+
+    def invalidate(self):
+        """Forget everything after a roster write in this process"""
+        self.clear()
+        self.generation = None
+
+    def stats(self):
+        hits = self.by_idno.hits + self.by_id.hits
+        misses = self.by_idno.misses + self.by_id.misses
+        return {
+            'size': len(self.by_idno),
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'invalidations': self.invalidations,
+        }
+
+
+student_cache = StudentCache()
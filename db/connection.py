@@ -0,0 +1,445 @@
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+from flask import g, has_app_context
+
+from db.metrics import registry
+
+slow_log = logging.getLogger('db.slow_query')
+
+DATABASE = os.environ.get('SCHOOL_DB', os.path.join(os.path.dirname(__file__), 'school.db'))
+
+# Pool and pragma settings; override with configure() before the first query
+POOL_SIZE = 8
+# Seconds a caller waits for one of the pool's connections before giving up
+POOL_TIMEOUT = 5
+STATEMENT_CACHE_SIZE = 256
+PRAGMAS = {
+    'busy_timeout': 5000,       # wait up to 5s for the writer lock instead of failing
+    'synchronous': 'NORMAL',    # safe under WAL, one fsync per checkpoint instead of per commit
+    'cache_size': -16000,       # 16MB page cache per connection
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# Statements slower than this are logged with their query plan; None turns
+# the check off entirely. Set SLOW_QUERY_MS in the environment to enable it.
+SLOW_QUERY_SECONDS = float(os.environ['SLOW_QUERY_MS']) / 1000 if os.environ.get('SLOW_QUERY_MS') else None
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+# Read path. Report, export and listing helpers read through a second pool of
+# read-only connections, so a long admin read never waits for, or holds, one
+# of the connections the kiosk writes use. With READ_STALENESS set (seconds,
+# SCHOOL_READ_STALENESS in the environment) they read a copy of the database
+# made with the online backup API instead, taken again once it is older than
+# that; the live file then only sees the copy's single read.
+READ_POOL_SIZE = 4
+READ_STALENESS = float(os.environ['SCHOOL_READ_STALENESS']) if os.environ.get('SCHOOL_READ_STALENESS') else None
+
+
+def _log_slow_query(db, sql, parameters, elapsed):
+    registry.inc('db_slow_queries_total')
+    statement = ' '.join(sql.split())
+    plan = []
+    if statement.upper().startswith(EXPLAINABLE):
+        try:
+            plan = [row[3] for row in sqlite3.Connection.execute(db, 'EXPLAIN QUERY PLAN ' + sql, parameters)]
+        except sqlite3.Error:
+            pass
+    slow_log.warning('%.1fms: %s | plan: %s', elapsed * 1000, statement, ' / '.join(plan) or '-')
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to the pool"""
+
+    pool = None
+    request_bound = False
+
+    def execute(self, sql, parameters=()):
+        if SLOW_QUERY_SECONDS is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        cursor = super().execute(sql, parameters)
+        elapsed = time.perf_counter() - started
+        if elapsed >= SLOW_QUERY_SECONDS:
+            _log_slow_query(self, sql, parameters, elapsed)
+        return cursor
+
+    def close(self):
+        # Helpers close after every statement; keep the connection open while
+        # it belongs to a request and recycle it otherwise. Uncommitted work is
+        # dropped either way, as it was when close() really closed.
+        if self.request_bound:
+            if self.in_transaction:
+                self.rollback()
+            return
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+    def discard(self):
+        """Really close the underlying sqlite3 connection"""
+        self.pool = None
+        super().close()
+
+
+def _read_only_uri(path):
+    return f'file:{pathname2url(os.path.abspath(path))}?mode=ro'
+
+
+class PoolExhausted(sqlite3.OperationalError):
+    """Raised when every connection of a pool stays checked out for POOL_TIMEOUT seconds"""
+
+
+class ConnectionPool:
+    """Bounded LIFO pool of configured sqlite3 connections
+
+    At most size connections are checked out at once; further callers wait
+    for one to come back. A read_only pool opens its connections with mode=ro and query_only set,
+    so nothing read through it can write, attached databases included.
+    """
+
+    def __init__(self, database, size=POOL_SIZE, pragmas=None, read_only=False):
+        self.database = database
+        self.size = size
+        self.pragmas = dict(PRAGMAS if pragmas is None else pragmas)
+        self.read_only = read_only
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._wal_checked = read_only
+        self.retired = False
+        self.on_drained = None
+        self.opened = 0
+        self.in_use = 0
+
+    def _connect(self):
+        if self.read_only:
+            db = sqlite3.connect(_read_only_uri(self.database), uri=True, factory=PooledConnection,
+                                 check_same_thread=False,
+                                 cached_statements=STATEMENT_CACHE_SIZE)
+        else:
+            db = sqlite3.connect(self.database, factory=PooledConnection,
+                                 check_same_thread=False,
+                                 cached_statements=STATEMENT_CACHE_SIZE)
+        db.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            db.execute(f'PRAGMA {name} = {value}')
+        if self.read_only:
+            db.execute('PRAGMA query_only = ON')
+        if not self._wal_checked:
+            # journal_mode is stored in the database file, so set it once
+            db.execute('PRAGMA journal_mode = WAL')
+            self._wal_checked = True
+        db.pool = self
+        with self._lock:
+            self.opened += 1
+        return db
+
+    def acquire(self, timeout=None):
+        """Take an idle connection or open a new one, waiting while size are checked out"""
+        if not self._slots.acquire(timeout=POOL_TIMEOUT if timeout is None else timeout):
+            raise PoolExhausted(f'all {self.size} connections to {self.database} are in use')
+        try:
+            db = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                db = self._connect()
+            except BaseException:
+                self._slots.release()
+                raise
+        db.row_factory = sqlite3.Row
+        with self._lock:
+            self.in_use += 1
+        return db
+
+    def release(self, db):
+        """Return a connection, rolling back anything left uncommitted"""
+        with self._lock:
+            self.in_use -= 1
+        try:
+            if db.in_transaction:
+                db.rollback()
+        finally:
+            self._slots.release()
+        if self.retired:
+            self._discard(db)
+            return
+        try:
+            self._idle.put_nowait(db)
+        except queue.Full:
+            self._discard(db)
+            return
+        if self.retired:
+            # Retired while this one was on its way back
+            self.close_all()
+
+    def _discard(self, db):
+        with self._lock:
+            self.opened -= 1
+            drained = self.retired and self.opened == 0
+        db.discard()
+        if drained and self.on_drained is not None:
+            self.on_drained()
+
+    def warm(self, count=None):
+        """Open up to count idle connections ahead of the first request"""
+        count = self.size if count is None else min(count, self.size)
+        while self._idle.qsize() + self.in_use < count:
+            self._idle.put_nowait(self._connect())
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(db)
+
+    def retire(self, on_drained=None):
+        """Close idle connections now and the rest as they come back
+
+        on_drained() is called once the last connection has closed.
+        """
+        self.on_drained = on_drained
+        self.retired = True
+        with self._lock:
+            unused = self.opened == 0
+        if unused and on_drained is not None:
+            on_drained()
+        else:
+            self.close_all()
+
+
+class Snapshot:
+    """Backup-API copies of a database, each read through a read-only pool
+
+    A copy older than max_staleness seconds is replaced by a fresh one when
+    the next reader asks for it; readers still on the old copy finish there
+    and its file is removed when the last of them is done.
+    """
+
+    def __init__(self, database, max_staleness, size=READ_POOL_SIZE):
+        self.database = database
+        self.max_staleness = max_staleness
+        self.size = size
+        self.taken_at = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._directory = None
+        self._copies = 0
+
+    def _stale(self):
+        return self._pool is None or time.monotonic() - self.taken_at > self.max_staleness
+
+    def pool(self):
+        """The pool of the current copy, taking a new copy first if it is too old"""
+        if self._stale():
+            with self._lock:
+                if self._stale():
+                    self._refresh()
+        return self._pool
+
+    def age(self):
+        """Seconds since the current copy was taken, or None before the first"""
+        return None if self.taken_at is None else time.monotonic() - self.taken_at
+
+    def _refresh(self):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='school-snapshot-')
+            atexit.register(shutil.rmtree, self._directory, True)
+        self._copies += 1
+        path = os.path.join(self._directory, f'snapshot-{self._copies}.db')
+        started = time.monotonic()
+        source = sqlite3.connect(_read_only_uri(self.database), uri=True)
+        target = sqlite3.connect(path)
+        try:
+            # One read transaction on the live file; under WAL it blocks no writer
+            source.backup(target)
+            # The copy inherits WAL mode, which a mode=ro reader cannot open
+            # without its -shm file
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            source.close()
+        pool = ConnectionPool(path, self.size, read_only=True)
+        old, self._pool = self._pool, pool
+        self.taken_at = started
+        if old is not None:
+            old.retire(lambda: _remove_quietly(old.database))
+
+    @property
+    def opened(self):
+        return self._pool.opened if self._pool is not None else 0
+
+    @property
+    def in_use(self):
+        return self._pool.in_use if self._pool is not None else 0
+
+    def close_all(self):
+        """Drop the current copy and remove every copy no reader still has open"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.retire(lambda path=self._pool.database: _remove_quietly(path))
+                self._pool = None
+                self.taken_at = None
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+_pool = None
+_read_source = None
+_pool_lock = threading.Lock()
+
+
+def configure(database=None, pool_size=None, slow_query_ms=None, read_staleness=None, **pragmas):
+    """Change the database path, pool size, slow-query threshold, read staleness or pragmas and reset the pools
+
+    read_staleness is in seconds; 0 reads the live database again instead of a snapshot.
+    """
+    global DATABASE, POOL_SIZE, SLOW_QUERY_SECONDS, READ_STALENESS
+    moved = database and database != DATABASE
+    if database:
+        DATABASE = database
+    if pool_size:
+        POOL_SIZE = pool_size
+    if slow_query_ms is not None:
+        SLOW_QUERY_SECONDS = slow_query_ms / 1000 if slow_query_ms > 0 else None
+    if read_staleness is not None:
+        READ_STALENESS = read_staleness if read_staleness > 0 else None
+    PRAGMAS.update(pragmas)
+    close_pools()
+    if moved:
+        # Imported here: db.presence reads through this module
+        from db.presence import today_presence
+        today_presence.clear()
+
+
+def close_pools():
+    """Close every idle connection and drop both pools, e.g. before forking workers"""
+    global _pool, _read_source
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+        if _read_source is not None:
+            _read_source.close_all()
+        _pool = None
+        _read_source = None
+
+
+def warm_pools():
+    """Open the write and read pools' connections ahead of the first request"""
+    get_pool().warm()
+    _read_pool().warm()
+
+
+def get_pool():
+    """Get the process-wide connection pool"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE, POOL_SIZE)
+    return _pool
+
+
+def get_read_source():
+    """The read-only pool, or the snapshot, that get_read_db() draws from"""
+    global _read_source
+    if _read_source is None:
+        with _pool_lock:
+            if _read_source is None:
+                if READ_STALENESS:
+                    _read_source = Snapshot(DATABASE, READ_STALENESS)
+                else:
+                    _read_source = ConnectionPool(DATABASE, READ_POOL_SIZE, read_only=True)
+    return _read_source
+
+
+def read_staleness():
+    """Seconds the read path lags the live database by (0 while it reads the live file)"""
+    source = _read_source
+    return (source.age() or 0.0) if isinstance(source, Snapshot) else 0.0
+
+
+def _read_pool():
+    source = get_read_source()
+    return source.pool() if isinstance(source, Snapshot) else source
+
+
+def get_db():
+    """Get database connection
+
+    Inside a Flask app context the same connection is reused for the whole
+    request and released by close_request_db(). Elsewhere a pooled connection
+    is checked out and goes back to the pool on close().
+    """
+    if has_app_context():
+        db = g.get('_db')
+        if db is None:
+            db = get_pool().acquire()
+            db.request_bound = True
+            g._db = db
+        return db
+    return get_pool().acquire()
+
+
+def get_read_db():
+    """Get a read-only connection for reports, exports and listings
+
+    Same lifetime rules as get_db(), but from the read pool (or snapshot),
+    so it may lag the live database by up to READ_STALENESS seconds.
+    """
+    if has_app_context():
+        db = g.get('_read_db')
+        if db is None:
+            db = _read_pool().acquire()
+            db.request_bound = True
+            g._read_db = db
+        return db
+    return _read_pool().acquire()
+
+
+def close_request_db(exception=None):
+    """Release the request's connections (registered as an app teardown)"""
+    for name in ('_db', '_read_db'):
+        db = g.pop(name, None)
+        if db is not None:
+            db.request_bound = False
+            db.close()
+
+
+@contextmanager
+def connection():
+    """Check out a connection that is not tied to the current request"""
+    db = get_pool().acquire()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@contextmanager
+def read_connection():
+    """Check out a read-only connection that is not tied to the current request"""
+    db = _read_pool().acquire()
+    try:
+        yield db
+    finally:
+        db.close()
@@ -1,17 +1,25 @@
 import sqlite3
-import os
+import base64
+import json
+import logging
+import re
+import time
 from werkzeug.security import generate_password_hash
 from datetime import datetime, timedelta
+from db.connection import get_db, get_read_db, get_pool, get_read_source, read_staleness, connection, read_connection
+from db.migrations import check_query_plans, rebuild_attendance_daily
+from db.archive import read_with_archives, archived_daily_counts
+from db import photostore
+from db.cache import student_cache, StudentRecord, STUDENT_COLUMNS
+from db.writer import AttendanceWriter, WriterBusy
+from db.events import attendance_bell
+from db.presence import today_presence
+from db.metrics import registry, timed
 
-DATABASE = os.path.join(os.path.dirname(__file__), 'school.db')
-
-def get_db():
-    """Get database connection"""
-    db = sqlite3.connect(DATABASE)
-    db.row_factory = sqlite3.Row
-    return db
+log = logging.getLogger(__name__)
 
 # User functions
+@timed
 def get_user_by_email(email):
     """Get user by email"""
     db = get_db()
@@ -19,6 +27,7 @@ def get_user_by_email(email):
     db.close()
     return user
 
+@timed
 def get_user_by_id(user_id):
     """Get user by ID"""
     db = get_db()
@@ -26,6 +35,7 @@ def get_user_by_id(user_id):
     db.close()
     return user
 
+@timed
 def get_all_users():
     """Get all users"""
     db = get_db()
@@ -33,6 +43,7 @@ def get_all_users():
     db.close()
     return users
 
+@timed
 def create_user(email, password, name=''):
     """Create new user"""
     db = get_db()
@@ -47,6 +58,7 @@ def create_user(email, password, name=''):
         db.close()
         return False
 
+@timed
 def update_user(user_id, email, password, name=''):
     """Update user"""
     db = get_db()
@@ -61,6 +73,7 @@ def update_user(user_id, email, password, name=''):
         db.close()
         return False
 
+@timed
 def delete_user(user_id):
     """Delete user"""
     db = get_db()
@@ -69,57 +82,208 @@ def delete_user(user_id):
     db.close()
 
 # Student functions
+@timed
 def get_all_students():
     """Get all students"""
-    db = get_db()
-    students = db.execute('SELECT * FROM students ORDER BY lastname, firstname').fetchall()
+    db = get_read_db()
+    students = db.execute(f'''
+        SELECT {STUDENT_COLUMNS}
+        FROM students ORDER BY lastname, firstname
+    ''').fetchall()
     db.close()
     return students
 
-def get_student_by_id(student_id):
-    """Get student by ID"""
-    db = get_db()
-    student = db.execute('SELECT * FROM students WHERE id = ?', (student_id,)).fetchone()
+# Keyset pagination: a page ends with an opaque cursor holding the sort key
+# of its last row, and the next page seeks past it through an index, so
+# every page costs the same however deep into the list it is.
+def encode_cursor(*values):
+    """Pack sort-key values into an opaque page cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, length):
+    """Unpack a page cursor; raises ValueError if it is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('invalid cursor')
+    if (not isinstance(values, list) or len(values) != length
+            or not all(isinstance(value, (str, int)) for value in values)):
+        raise ValueError('invalid cursor')
+    return values
+
+def students_page_sql(conditions):
+    """SQL for one page of students matching the given WHERE conditions"""
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    return f"""
+        SELECT {STUDENT_COLUMNS}, idno_key FROM students
+        {where}
+        ORDER BY idno_key, id
+        LIMIT ?
+    """
+
+@timed
+def get_students_page(after=None, limit=50, course=None, level=None):
+    """Get one page of students in IDNO order
+
+    Returns (students, next_cursor); next_cursor is None on the last page.
+    """
+    conditions = []
+    params = []
+    if course:
+        conditions.append('course = ?')
+        params.append(course)
+    if level:
+        conditions.append('level = ?')
+        params.append(level)
+    if after:
+        conditions.append('(idno_key, id) > (?, ?)')
+        params.extend(decode_cursor(after, 2))
+    db = get_read_db()
+    rows = db.execute(students_page_sql(conditions), (*params, limit + 1)).fetchall()
+    db.close()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['idno_key'], rows[-1]['id'])
+    return [StudentRecord(row) for row in rows], next_cursor
+
+# Roster search (FTS5). Every word typed must prefix-match some field;
+# bm25 weights rank IDNO hits above names, and names above course.
+MAX_SEARCH_TERMS = 6
+
+SEARCH_STUDENTS_SQL = f"""
+    SELECT {', '.join('s.' + column for column in STUDENT_COLUMNS.split(', '))}
+    FROM students_fts
+    JOIN students s ON s.id = students_fts.rowid
+    WHERE students_fts MATCH ?
+    ORDER BY bm25(students_fts, 10.0, 4.0, 4.0, 1.0)
+    LIMIT ?
+"""
+
+@timed
+def search_students(query, limit=10):
+    """Typeahead search over IDNO, names and course; best matches first"""
+    terms = re.findall(r'\w+', query or '')[:MAX_SEARCH_TERMS]
+    if not terms:
+        return []
+    match = ' '.join(f'"{term}"*' for term in terms)
+    db = get_read_db()
+    rows = db.execute(SEARCH_STUDENTS_SQL, (match, limit)).fetchall()
+    db.close()
+    return [StudentRecord(row) for row in rows]
+
+@timed
+def select_students(student_ids=None, course=None, level=None):
+    """Students for a batch job (QR codes, ID cards), in IDNO order
+
+    student_ids limits the selection to those ids; course and level filter
+    it as on the student list. With no arguments every student is returned.
+    """
+    conditions = []
+    params = []
+    if student_ids is not None:
+        # One bound JSON array instead of a variable-length IN (?, ?, ...)
+        conditions.append('id IN (SELECT value FROM json_each(?))')
+        params.append(json.dumps([int(student_id) for student_id in student_ids]))
+    if course:
+        conditions.append('course = ?')
+        params.append(course)
+    if level:
+        conditions.append('level = ?')
+        params.append(level)
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    db = get_read_db()
+    rows = db.execute(f'SELECT {STUDENT_COLUMNS} FROM students {where} ORDER BY idno_key, id', params).fetchall()
     db.close()
+    return [StudentRecord(row) for row in rows]
+
+STUDENT_BY_ID_SQL = f'SELECT {STUDENT_COLUMNS} FROM students WHERE id = ?'
+STUDENT_BY_IDNO_SQL = f'SELECT {STUDENT_COLUMNS} FROM students WHERE idno = ?'
+
+def _lookup_student(by, key, sql):
+    """Serve a student from the cache, falling back to the database"""
+    student, generation = student_cache.lookup(key, by)
+    if student is None:
+        db = get_db()
+        row = db.execute(sql, (key,)).fetchone()
+        db.close()
+        if row is None:
+            return None
+        student = StudentRecord(row)
+        student_cache.put(student, generation)
     return student
 
+@timed
+def get_student_by_id(student_id):
+    """Get student by ID"""
+    try:
+        student_id = int(student_id)
+    except (TypeError, ValueError):
+        return None
+    return _lookup_student('id', student_id, STUDENT_BY_ID_SQL)
+
+@timed
 def get_student_by_idno(idno):
     """Get student by IDNO"""
-    db = get_db()
-    student = db.execute('SELECT * FROM students WHERE idno = ?', (idno,)).fetchone()
-    db.close()
-    return student
+    return _lookup_student('idno', idno, STUDENT_BY_IDNO_SQL)
+
+def student_cache_stats():
+    """Hit/miss counters of the student lookup cache"""
+    return student_cache.stats()
 
-def create_student(idno, firstname, lastname, course, level, photo_data=None):
-    """Create new student"""
+@timed
+def create_student(idno, firstname, lastname, course, level, photo_data=None, photo_hash=None):
+    """Create new student; returns the new student's id, or False if the IDNO is taken
+
+    Pass the photo as bytes (photo_data) or as the hash of an image already
+    in the photo store (photo_hash).
+    """
+    if photo_data:
+        photo_hash = photostore.put(photo_data)
     db = get_db()
     try:
-        db.execute('INSERT INTO students (idno, firstname, lastname, course, level, photo) VALUES (?, ?, ?, ?, ?, ?)',
-                  (idno, firstname, lastname, course, level, photo_data))
+        cursor = db.execute('INSERT INTO students (idno, firstname, lastname, course, level, photo_hash) VALUES (?, ?, ?, ?, ?, ?)',
+                  (idno, firstname, lastname, course, level, photo_hash))
         db.commit()
         db.close()
-        return True
+        student_cache.invalidate()
+        return cursor.lastrowid
     except sqlite3.IntegrityError:
         db.close()
         return False
 
-def update_student(student_id, idno, firstname, lastname, course, level, photo_data=None):
-    """Update student"""
+@timed
+def update_student(student_id, idno, firstname, lastname, course, level, photo_data=None, photo_hash=None):
+    """Update student; the photo is only replaced when photo_data or photo_hash is given"""
+    if photo_data:
+        photo_hash = photostore.put(photo_data)
     db = get_db()
     try:
-        if photo_data:
-            db.execute('UPDATE students SET idno=?, firstname=?, lastname=?, course=?, level=?, photo=? WHERE id=?',
-                      (idno, firstname, lastname, course, level, photo_data, student_id))
+        if photo_hash:
+            db.execute('UPDATE students SET idno=?, firstname=?, lastname=?, course=?, level=?, photo_hash=? WHERE id=?',
+                      (idno, firstname, lastname, course, level, photo_hash, student_id))
         else:
             db.execute('UPDATE students SET idno=?, firstname=?, lastname=?, course=?, level=? WHERE id=?',
                       (idno, firstname, lastname, course, level, student_id))
         db.commit()
         db.close()
+        student_cache.invalidate()
         return True
     except sqlite3.IntegrityError:
         db.close()
         return False
 
+@timed
+def set_student_photo(student_id, photo_hash):
+    """Point a student at a stored photo; returns False if there is no such student"""
+    db = get_db()
+    cursor = db.execute('UPDATE students SET photo_hash = ? WHERE id = ?', (photo_hash, student_id))
+    db.commit()
+    db.close()
+    student_cache.invalidate()
+    return cursor.rowcount == 1
+
+@timed
 def delete_student(student_id):
     """Delete student and related attendance records"""
     db = get_db()
@@ -127,57 +291,280 @@ def delete_student(student_id):
     db.execute('DELETE FROM students WHERE id = ?', (student_id,))
     db.commit()
     db.close()
+    student_cache.invalidate()
+    today_presence.discard(int(student_id))
+
+def get_student_photo(student):
+    """Get a student's photo bytes from the photo store, or None"""
+    try:
+        photo_hash = student['photo_hash']
+    except (KeyError, IndexError, TypeError):
+        return None
+    return photostore.get(photo_hash) if photo_hash else None
+
+@timed
+def prune_photos():
+    """Delete stored photos no student refers to; returns the count"""
+    db = get_db()
+    rows = db.execute('SELECT photo_hash FROM students WHERE photo_hash IS NOT NULL').fetchall()
+    db.close()
+    return photostore.prune({row['photo_hash'] for row in rows})
 
 # Attendance functions
+
+# Hot attendance queries; the plain column comparisons let SQLite use the
+# indexes from the attendance migration instead of scanning the table.
+# The UNIQUE (student_id, date) index makes the insert itself the
+# "already present today" check, so two kiosks scanning the same card at
+# once cannot both record it.
+MARK_ATTENDANCE_SQL = """
+    INSERT INTO attendance (student_id, time_in, date) VALUES (?, ?, ?)
+    ON CONFLICT (student_id, date) DO NOTHING
+"""
+
+def ph_now():
+    """Get today's date and the current timestamp in Philippine time (UTC+8)"""
+    now_ph = datetime.utcnow() + timedelta(hours=8)
+    return now_ph.strftime('%Y-%m-%d'), now_ph.strftime('%Y-%m-%d %H:%M:%S')
+
+def day_bounds(date_str):
+    """Get the [start, end) time_in range covering one YYYY-MM-DD day"""
+    day = datetime.strptime(date_str, '%Y-%m-%d')
+    return day.strftime('%Y-%m-%d'), (day + timedelta(days=1)).strftime('%Y-%m-%d')
+
+# Optional group-commit write path, see start_attendance_writer()
+_attendance_writer = None
+
+def start_attendance_writer(**options):
+    """Send attendance inserts through a group-commit writer thread
+
+    options are passed to AttendanceWriter (max_batch, max_delay,
+    queue_size, durability, submit_timeout, commit_timeout).
+    """
+    global _attendance_writer
+    stop_attendance_writer()
+    _attendance_writer = AttendanceWriter(MARK_ATTENDANCE_SQL, **options)
+    _attendance_writer.start()
+    return _attendance_writer
+
+def stop_attendance_writer():
+    """Flush the writer thread and go back to committing per request"""
+    global _attendance_writer
+    if _attendance_writer is not None:
+        _attendance_writer.stop()
+        _attendance_writer = None
+
+# Repeat scans of a card that is already in for the day are answered from
+# today_presence without touching the database
+ALREADY_PRESENT = {'recorded': False, 'already_present': True}
+
+def _mark_present(db, student_id):
+    """Insert today's attendance row; returns the record_attendance result dict"""
+    today, time_in_str = ph_now()
+    if _attendance_writer is not None:
+        recorded = _attendance_writer.submit(student_id, time_in_str, today)
+    else:
+        cursor = db.execute(MARK_ATTENDANCE_SQL, (student_id, time_in_str, today))
+        db.commit()
+        recorded = cursor.rowcount == 1
+    today_presence.add(student_id, today)
+    if recorded:
+        attendance_bell.ring()
+    return {'recorded': recorded, 'already_present': not recorded}
+
+@timed
 def record_attendance(student_id):
     """Record attendance for student if not already recorded today"""
-    from datetime import datetime, timedelta
+    if today_presence.contains(student_id, ph_now()[0]):
+        return dict(ALREADY_PRESENT)
     db = get_db()
     try:
-        # Get current date in Philippine timezone (UTC+8)
-        ph_tz_offset = timedelta(hours=8)
-        today = (datetime.utcnow() + ph_tz_offset).strftime('%Y-%m-%d')
-        
-        # Check if student already has attendance for today
-        existing = db.execute('''
-            SELECT id FROM attendance 
-            WHERE student_id = ? AND DATE(date) = ?
-        ''', (student_id, today)).fetchone()
-        
-        if existing:
-            db.close()
-            return {'recorded': False, 'already_present': True}
-        
-        # Record new attendance with Philippine timezone timestamp
-        now_ph = datetime.utcnow() + ph_tz_offset
-        time_in_str = now_ph.strftime('%Y-%m-%d %H:%M:%S')
-        db.execute('INSERT INTO attendance (student_id, time_in, date) VALUES (?, ?, ?)', 
-                   (student_id, time_in_str, today))
-        db.commit()
+        result = _mark_present(db, student_id)
+        db.close()
+        return result
+    except WriterBusy:
         db.close()
-        return {'recorded': True, 'already_present': False}
-    except Exception as e:
-        print(f"Error recording attendance: {str(e)}")
+        return {'recorded': False, 'already_present': False, 'busy': True}
+    except Exception:
+        log.exception('Error recording attendance')
         db.close()
         return {'recorded': False, 'already_present': False}
 
-def get_attendance_by_date(date_str):
-    conn = get_db()
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT a.id, s.idno, s.firstname, s.lastname, s.course, s.level, a.time_in
-        FROM attendance a
-        JOIN students s ON a.student_id = s.id
-        WHERE DATE(a.time_in) = ?
-        ORDER BY a.time_in ASC
-    """, (date_str,))
-    
-    attendance = cursor.fetchall()
-    conn.close()
-    
-    # Format the time_in - it's already in Philippine time from record_attendance()
+@timed
+def mark_attendance_by_idno(idno):
+    """Look up a student by IDNO and mark them present today
+
+    Returns (student, result) where result is the record_attendance dict,
+    or (None, None) if no student has that IDNO.
+    """
+    student = get_student_by_idno(idno)
+    if not student:
+        return None, None
+    if today_presence.contains(student['id'], ph_now()[0]):
+        return student, dict(ALREADY_PRESENT)
+    db = get_db()
+    try:
+        result = _mark_present(db, student['id'])
+        db.close()
+        return student, result
+    except WriterBusy:
+        db.close()
+        return student, {'recorded': False, 'already_present': False, 'busy': True}
+    except Exception:
+        log.exception('Error recording attendance')
+        db.close()
+        return student, {'recorded': False, 'already_present': False}
+
+# Batched attendance from kiosks that were offline
+MAX_BATCH_EVENTS = 1000
+SQL_IN_CHUNK = 500
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+# Oldest offline scan a kiosk may still upload
+MAX_SCAN_AGE = timedelta(days=3)
+
+class ScanTooOld(ValueError):
+    """Raised for a scan older than the offline window"""
+
+def parse_scan_time(value):
+    """Convert a kiosk scan timestamp to Philippine (date, time_in) strings
+
+    Accepts epoch milliseconds, ISO 8601 with an offset or Z, or a naive
+    'YYYY-MM-DD HH:MM:SS' already in Philippine time. Missing means now.
+    Raises ScanTooOld for scans more than MAX_SCAN_AGE in the past.
+    """
+    ph_tz_offset = timedelta(hours=8)
+    now_ph = datetime.utcnow() + ph_tz_offset
+    if value is None or value == '':
+        scanned = now_ph
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        scanned = datetime.utcfromtimestamp(value / 1000) + ph_tz_offset
+    elif isinstance(value, str):
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo is not None:
+            parsed = parsed.replace(tzinfo=None) - parsed.utcoffset() + ph_tz_offset
+        scanned = parsed
+    else:
+        raise ValueError('unsupported timestamp')
+    if scanned > now_ph + MAX_CLOCK_SKEW:
+        raise ValueError('timestamp is in the future')
+    if scanned < now_ph - MAX_SCAN_AGE:
+        raise ScanTooOld('timestamp is older than the offline window')
+    return scanned.strftime('%Y-%m-%d'), scanned.strftime('%Y-%m-%d %H:%M:%S')
+
+def _chunks(items, size=SQL_IN_CHUNK):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+@timed
+def record_attendance_batch(events):
+    """Record a batch of offline scans in one transaction
+
+    events is a list of {'idno', 'scanned_at', 'key'} dicts. Returns one
+    {'key', 'idno', 'status'} result per event, in order, where status is
+    'recorded', 'already_present', 'not_found', 'invalid' or 'too_old' (past
+    MAX_SCAN_AGE, or on a day of an archived term). A key that was already
+    processed returns its original status with 'duplicate': True.
+    """
+    results = [None] * len(events)
+    parsed = []
+    for index, event in enumerate(events):
+        event = event if isinstance(event, dict) else {}
+        key = event.get('key')
+        key = str(key) if key not in (None, '') else None
+        idno = event.get('idno')
+        result = {'key': key, 'idno': idno}
+        results[index] = result
+        if not isinstance(idno, str) or not idno:
+            result['status'] = 'invalid'
+            continue
+        try:
+            date, time_in = parse_scan_time(event.get('scanned_at'))
+        except ScanTooOld:
+            result['status'] = 'too_old'
+            continue
+        except (ValueError, TypeError, OverflowError, OSError):
+            result['status'] = 'invalid'
+            continue
+        parsed.append((index, key, idno, date, time_in))
+
+    if not parsed:
+        return results
+
+    db = get_db()
+    try:
+        # Hold the write lock for the whole batch so the checks below stay true
+        db.execute('BEGIN IMMEDIATE')
+
+        keys = {key for _, key, _, _, _ in parsed if key}
+        seen = {}
+        for chunk in _chunks(keys):
+            marks = ','.join('?' * len(chunk))
+            for row in db.execute(f'SELECT key, status FROM scan_receipts WHERE key IN ({marks})', chunk):
+                seen[row['key']] = row['status']
+
+        idnos = {idno for _, _, idno, _, _ in parsed}
+        student_ids = {}
+        for chunk in _chunks(idnos):
+            marks = ','.join('?' * len(chunk))
+            for row in db.execute(f'SELECT id, idno FROM students WHERE idno IN ({marks})', chunk):
+                student_ids[row['idno']] = row['id']
+
+        dates = [date for _, _, _, date, _ in parsed]
+        present = set()
+        for chunk in _chunks(set(student_ids.values())):
+            marks = ','.join('?' * len(chunk))
+            present.update(
+                (row['student_id'], row['date']) for row in db.execute(f"""
+                    SELECT student_id, date FROM attendance
+                    WHERE student_id IN ({marks}) AND date BETWEEN ? AND ?
+                """, (*chunk, min(dates), max(dates))))
+        # Archived days are read from the archive files, so a late row here would count twice
+        archived = db.execute('SELECT first_date, last_date FROM archived_terms WHERE first_date <= ? AND last_date >= ?',
+                              (max(dates), min(dates))).fetchall()
+
+        # Earliest scan of the day wins when the same card was queued twice
+        new_rows = []
+        receipts = []
+        for index, key, idno, date, time_in in sorted(parsed, key=lambda p: p[4]):
+            result = results[index]
+            if key in seen:
+                result['status'] = seen[key]
+                result['duplicate'] = True
+                continue
+            student_id = student_ids.get(idno)
+            if student_id is None:
+                result['status'] = 'not_found'
+            elif any(term['first_date'] <= date <= term['last_date'] for term in archived):
+                result['status'] = 'too_old'
+            elif (student_id, date) in present:
+                result['status'] = 'already_present'
+            else:
+                present.add((student_id, date))
+                new_rows.append((student_id, time_in, date))
+                result['status'] = 'recorded'
+            if key:
+                seen[key] = result['status']
+                receipts.append((key, result['status']))
+
+        db.executemany(MARK_ATTENDANCE_SQL, new_rows)
+        db.executemany('INSERT OR IGNORE INTO scan_receipts (key, status) VALUES (?, ?)', receipts)
+        db.commit()
+        db.close()
+        today = ph_now()[0]
+        for student_id, date in present:
+            if date == today:
+                today_presence.add(student_id, date)
+        if new_rows:
+            attendance_bell.ring()
+    except Exception:
+        db.rollback()
+        db.close()
+        raise
+    return results
+
+def _format_attendance(attendance):
+    """Format time_in as 12-hour time; it's already in Philippine time from record_attendance()"""
     formatted_attendance = []
     for record in attendance:
         try:
@@ -188,13 +575,124 @@ def get_attendance_by_date(date_str):
             formatted_record['time_in'] = formatted_time
             formatted_attendance.append(formatted_record)
         except (ValueError, TypeError):
-            formatted_attendance.append(record)
+            formatted_attendance.append(dict(record))
     
     return formatted_attendance
 
+@timed
+def get_attendance_by_date(date_str):
+    try:
+        start, end = day_bounds(date_str)
+    except (ValueError, TypeError):
+        return []
+    # A negative LIMIT is no limit in SQLite
+    return _format_attendance(_read_day(start, end, None, -1))
+
+def attendance_page_sql(seek, archives=()):
+    """SQL for one page of a day's attendance, optionally seeking past a cursor
+
+    archives are the (schema, moved_through) pairs from read_with_archives();
+    each adds that archive's rows of the day to the live table's.
+    """
+    selects = []
+    for prefix, moved in [('', None)] + [(schema + '.', moved) for schema, moved in archives]:
+        selects.append(f"""
+        SELECT a.id, s.idno, s.firstname, s.lastname, s.course, s.level, a.time_in
+        FROM {prefix}attendance a
+        JOIN {prefix}students s ON a.student_id = s.id
+        WHERE a.time_in >= ? AND a.time_in < ? {'AND (a.time_in, a.id) > (?, ?)' if seek else ''}
+            {'AND a.id <= ?' if moved is not None else ''}""")
+    return ' UNION ALL '.join(selects) + """
+        ORDER BY 7, 1
+        LIMIT ?
+    """
+
+def _read_day(start, end, after, limit):
+    """Up to limit rows of one day after the (time_in, id) cursor, archived days included"""
+    params = [start, end]
+    if after:
+        after_time, after_id = after
+        # Start the index range at the cursor so deep pages seek, not skip
+        params = [max(start, str(after_time)), end, after_time, after_id]
+    db = get_read_db()
+    with read_with_archives(db, start, start) as archives:
+        all_params = list(params)
+        for _, moved in archives:
+            all_params += params + [moved]
+        rows = db.execute(attendance_page_sql(bool(after), archives), (*all_params, limit)).fetchall()
+    db.close()
+    return rows
+
+@timed
+def get_attendance_page(date_str, after=None, limit=100):
+    """Get one page of a day's attendance in time-in order
+
+    Days of an archived term are read from its archive. Returns (records,
+    next_cursor); next_cursor is None on the last page.
+    """
+    try:
+        start, end = day_bounds(date_str)
+    except (ValueError, TypeError):
+        return [], None
+    rows = _read_day(start, end, decode_cursor(after, 2) if after else None, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['time_in'], rows[-1]['id'])
+    return _format_attendance(rows), next_cursor
+
+# Live feed: rows are followed by attendance id. The unary + keeps SQLite
+# on the rowid range instead of walking the whole day in the date index.
+ATTENDANCE_SINCE_SQL = """
+    SELECT a.id, s.idno, s.firstname, s.lastname, s.course, s.level, a.time_in
+    FROM attendance a
+    JOIN students s ON a.student_id = s.id
+    WHERE a.id > ? AND +a.date = ?
+    ORDER BY a.id
+    LIMIT ?
+"""
+
+@timed
+def get_latest_attendance_id():
+    """Get the highest attendance id, the starting cursor for a live feed
+
+    Read from the same source as the attendance page, so a lagging snapshot
+    leaves the feed to catch up rather than skip rows.
+    """
+    db = get_read_db()
+    latest = db.execute('SELECT MAX(id) FROM attendance').fetchone()[0]
+    db.close()
+    return latest or 0
+
+def follow_attendance(date_str, after_id=0, poll_interval=2, heartbeat=15, lifetime=300, batch_size=200):
+    """Yield lists of a day's attendance records with id > after_id as they arrive
+
+    Wakes as soon as this process commits attendance, and polls every
+    poll_interval seconds for rows written by other processes. Yields an
+    empty list when heartbeat seconds pass without rows, and stops after
+    lifetime seconds so clients reconnect from their last id.
+    """
+    deadline = time.monotonic() + lifetime
+    last_yield = time.monotonic()
+    while time.monotonic() < deadline:
+        seen = attendance_bell.sequence
+        with connection() as db:
+            rows = db.execute(ATTENDANCE_SINCE_SQL, (after_id, date_str, batch_size)).fetchall()
+        if rows:
+            after_id = rows[-1]['id']
+            last_yield = time.monotonic()
+            yield _format_attendance(rows)
+            if len(rows) == batch_size:
+                continue
+        elif time.monotonic() - last_yield >= heartbeat:
+            last_yield = time.monotonic()
+            yield []
+        attendance_bell.wait(seen, min(poll_interval, max(deadline - time.monotonic(), 0)))
+
+@timed
 def get_all_attendance():
     """Get all attendance records"""
-    db = get_db()
+    db = get_read_db()
     attendance = db.execute('''
         SELECT s.id, s.idno, s.firstname, s.lastname, s.course, s.level, a.time_in, a.date
         FROM attendance a
@@ -204,6 +702,120 @@ def get_all_attendance():
     db.close()
     return attendance
 
+EXPORT_COLUMNS = ('attendance_id', 'date', 'time_in', 'idno', 'lastname', 'firstname', 'course', 'level')
+
+def iter_attendance(start=None, end=None, course=None, level=None, chunk_size=500):
+    """Yield attendance rows (EXPORT_COLUMNS order) in time_in order
+
+    start and end are inclusive YYYY-MM-DD dates. Archived terms the range
+    reaches are read too, merged into the same order. Rows are fetched
+    chunk_size at a time on a connection of their own, so the generator can
+    outlive the request that created it.
+    """
+    conditions = []
+    params = []
+    if start:
+        conditions.append('a.time_in >= ?')
+        params.append(day_bounds(start)[0])
+    if end:
+        conditions.append('a.time_in < ?')
+        params.append(day_bounds(end)[1])
+    if course:
+        conditions.append('s.course = ?')
+        params.append(course)
+    if level:
+        conditions.append('s.level = ?')
+        params.append(level)
+    with read_connection() as db, read_with_archives(db, start, end) as archives:
+        selects = []
+        all_params = []
+        # Archives carry their own student snapshot, so deleted students' history still exports
+        for prefix, extra in [('', [])] + [(schema + '.', [('a.id <= ?', moved)]) for schema, moved in archives]:
+            where = conditions + [condition for condition, _ in extra]
+            selects.append(f"""
+                SELECT a.id, a.date, a.time_in, s.idno, s.lastname, s.firstname, s.course, s.level
+                FROM {prefix}attendance a
+                JOIN {prefix}students s ON a.student_id = s.id
+                {'WHERE ' + ' AND '.join(where) if where else ''}""")
+            all_params += params + [value for _, value in extra]
+        # By time_in, then id; each branch walks its time_in index and
+        # SQLite merges them in order
+        sql = ' UNION ALL '.join(selects) + ' ORDER BY 3, 1'
+        cursor = db.execute(sql, all_params)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield tuple(row)
+        finally:
+            cursor.close()
+
+# Attendance summaries, read from the attendance_daily aggregate table that
+# triggers keep up to date, so a summary costs O(days x groups)
+
+ATTENDANCE_DAILY_SQL = """
+    SELECT date, course, level, present FROM attendance_daily
+    WHERE date BETWEEN ? AND ?
+    ORDER BY date, course, level
+"""
+
+ROSTER_GROUPS_SQL = 'SELECT course, level, COUNT(*) AS enrolled FROM students GROUP BY course, level'
+
+@timed
+def rebuild_attendance_aggregates():
+    """Recompute attendance_daily from the live table and the archives; returns the row count"""
+    with connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            rebuild_attendance_daily(db)
+            db.executemany("""
+                INSERT INTO attendance_daily (date, course, level, present) VALUES (?, ?, ?, ?)
+                ON CONFLICT (date, course, level) DO UPDATE SET present = present + excluded.present
+            """, archived_daily_counts(db))
+            count = db.execute('SELECT COUNT(*) FROM attendance_daily').fetchone()[0]
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return count
+
+@timed
+def get_attendance_summary(start, end):
+    """Per-day present/absent counts by course and level between two dates
+
+    Days without any attendance (weekends, holidays) are left out. Absent
+    counts are measured against the current roster.
+    """
+    db = get_read_db()
+    roster = {(row['course'], row['level']): row['enrolled'] for row in db.execute(ROSTER_GROUPS_SQL)}
+    rows = db.execute(ATTENDANCE_DAILY_SQL, (start, end)).fetchall()
+    db.close()
+
+    by_date = {}
+    for row in rows:
+        by_date.setdefault(row['date'], {})[(row['course'], row['level'])] = row['present']
+    enrolled_total = sum(roster.values())
+    days = []
+    for date_str, present_by_group in by_date.items():
+        groups = []
+        for course, level in sorted(set(roster) | set(present_by_group)):
+            present = present_by_group.get((course, level), 0)
+            enrolled = roster.get((course, level), 0)
+            groups.append({'course': course, 'level': level, 'present': present,
+                           'enrolled': enrolled, 'absent': max(enrolled - present, 0)})
+        present_total = sum(present_by_group.values())
+        days.append({
+            'date': date_str,
+            'present': present_total,
+            'enrolled': enrolled_total,
+            'absent': max(enrolled_total - present_total, 0),
+            'rate': round(present_total / enrolled_total, 4) if enrolled_total else 0.0,
+            'groups': groups,
+        })
+    return {'start': start, 'end': end, 'enrolled': enrolled_total, 'days': days}
+
 def reset_user_id_sequence():
     """Reset the user ID sequence to start from 1"""
     conn = sqlite3.connect('qrcode.db')
@@ -214,38 +826,52 @@ def reset_user_id_sequence():
 
 # Database utility functions for migration and debugging
 
-def migrate_add_photo_column():
-    """Add photo column to students table if it doesn't exist"""
-    db = get_db()
-    cursor = db.cursor()
-    
-    try:
-        cursor.execute("PRAGMA table_info(students)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'photo' not in columns:
-            print("Adding photo column to students table...")
-            cursor.execute("ALTER TABLE students ADD COLUMN photo BLOB")
-            db.commit()
-            print("Photo column added successfully!")
-        else:
-            print("Photo column already exists.")
-        
-        # Verify the column
-        cursor.execute("PRAGMA table_info(students)")
-        print("\nCurrent table schema:")
-        for col in cursor.fetchall():
-            print(f"  {col[1]} ({col[2]})")
-    finally:
-        db.close()
+# Queries that run on every scan or attendance page load, with sample
+# parameters for EXPLAIN QUERY PLAN
+HOT_QUERIES = {
+    'get_student_by_idno': (STUDENT_BY_IDNO_SQL, ('0',)),
+    'get_student_by_id': (STUDENT_BY_ID_SQL, (0,)),
+    'get_attendance_by_date': (attendance_page_sql(False), (*day_bounds('2000-01-01'), -1)),
+    'get_students_page': (students_page_sql(['(idno_key, id) > (?, ?)']), ('0', 0, 50)),
+    'get_students_page_filtered': (students_page_sql(['course = ?', 'level = ?', '(idno_key, id) > (?, ?)']),
+                                   ('BSIT', '1', '0', 0, 50)),
+    'get_students_page_level': (students_page_sql(['level = ?']), ('1', 50)),
+    'get_attendance_page': (attendance_page_sql(True), (*day_bounds('2000-01-01'), '2000-01-01', 0, 100)),
+    'get_attendance_summary': (ATTENDANCE_DAILY_SQL, ('2000-01-01', '2000-01-31')),
+    'follow_attendance': (ATTENDANCE_SINCE_SQL, (0, '2000-01-01', 200)),
+}
+
+def check_hot_query_plans():
+    """Return the hot queries whose plan falls back to a full table SCAN"""
+    return check_query_plans(HOT_QUERIES)
+
+# Values read when /metrics is scraped
+
+registry.gauge('db_pool_connections', 'Pooled SQLite connections by state',
+               lambda: [({'state': 'open'}, get_pool().opened), ({'state': 'in_use'}, get_pool().in_use)])
+registry.gauge('db_read_pool_connections', 'Read-only connections for reports and listings by state',
+               lambda: [({'state': 'open'}, get_read_source().opened), ({'state': 'in_use'}, get_read_source().in_use)])
+registry.gauge('db_read_snapshot_age_seconds', 'Age of the snapshot reports and listings read from',
+               read_staleness)
+registry.gauge('student_cache_lookups_total', 'Student cache lookups by result',
+               lambda: [({'result': 'hit'}, student_cache_stats()['hits']),
+                        ({'result': 'miss'}, student_cache_stats()['misses'])], kind='counter')
+registry.gauge('student_cache_hit_ratio', 'Share of student lookups served from the cache',
+               lambda: student_cache_stats()['hit_rate'])
+registry.gauge('student_cache_entries', 'Students currently cached', lambda: student_cache_stats()['size'])
+registry.gauge('attendance_writer_queue_depth', 'Inserts waiting for the group-commit writer',
+               lambda: _attendance_writer.queue_depth() if _attendance_writer is not None else 0)
+registry.gauge('presence_students', "Students in today's in-memory presence set", lambda: len(today_presence))
+registry.gauge('presence_hits_total', 'Repeat scans answered from the presence set',
+               lambda: today_presence.hits, kind='counter')
 
 def check_all_photos():
     """Check and display all students and their photo status"""
-    db = get_db()
+    db = get_read_db()
     cursor = db.cursor()
     
     try:
-        cursor.execute("SELECT id, idno, firstname, lastname, photo FROM students ORDER BY id")
+        cursor.execute("SELECT id, idno, firstname, lastname, photo_hash FROM students ORDER BY id")
         students = cursor.fetchall()
         
         print("\n=== All Students in Database ===")
@@ -253,19 +879,25 @@ def check_all_photos():
             print("No students found.")
         else:
             for student in students:
-                student_id, idno, firstname, lastname, photo = student
-                photo_status = f"Has photo ({len(photo)} bytes)" if photo else "No photo"
+                student_id, idno, firstname, lastname, photo_hash = student
+                photo_size = photostore.size(photo_hash) if photo_hash else None
+                if photo_size is not None:
+                    photo_status = f"Has photo ({photo_size} bytes)"
+                elif photo_hash:
+                    photo_status = "Photo file missing"
+                else:
+                    photo_status = "No photo"
                 print(f"  ID: {student_id}, IDNO: {idno}, Name: {firstname} {lastname}, Photo: {photo_status}")
     finally:
         db.close()
 
 def check_photos_simple():
     """Simple check: display all students and their photo status"""
-    db = get_db()
+    db = get_read_db()
     cursor = db.cursor()
     
     try:
-        cursor.execute("SELECT idno, firstname, lastname, photo FROM students")
+        cursor.execute("SELECT idno, firstname, lastname, photo_hash FROM students")
         students = cursor.fetchall()
         
         print("\n=== Students in Database ===")
@@ -273,8 +905,8 @@ def check_photos_simple():
             print("No students found.")
         else:
             for student in students:
-                idno, firstname, lastname, photo = student
-                photo_status = "Has photo" if photo else "No photo"
+                idno, firstname, lastname, photo_hash = student
+                photo_status = "Has photo" if photo_hash else "No photo"
                 print(f"  IDNO: {idno}, Name: {firstname} {lastname}, Photo: {photo_status}")
     finally:
         db.close()
\ No newline at end of file
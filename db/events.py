@@ -0,0 +1,29 @@
+import threading
+
+
+class Bell:
+    """Wakes threads in this process that are waiting for new rows
+
+    Writers ring() after they commit; listeners wait() with the sequence
+    number they last saw. Writes made by other processes never ring, so
+    listeners should also poll on a timeout.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.sequence = 0
+
+    def ring(self):
+        with self._condition:
+            self.sequence += 1
+            self._condition.notify_all()
+
+    def wait(self, seen, timeout):
+        """Block until a ring after sequence seen, or timeout; returns the new sequence"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.sequence != seen, timeout)
+            return self.sequence
+
+
+# Rung whenever attendance rows are committed
+attendance_bell = Bell()
@@ -0,0 +1,414 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from db import connection
+from db.metrics import registry
+
+log = logging.getLogger(__name__)
+
+# Background jobs. Long admin operations (imports, exports, archiving, QR
+# batches) are queued in the jobs table and run on a small thread pool, so
+# the request that starts one returns at once and the browser polls the
+# job's status instead.
+#
+# A job is claimed by flipping it from 'queued' to 'running' in one UPDATE,
+# so it runs once however many processes see it. Running jobs are stamped
+# with a heartbeat; a job whose process died stops being stamped, and the
+# sweeper puts it back in the queue to run again from the start. Job
+# functions are written to be safe to repeat (upserts, archive moves that
+# carry on from their last chunk, files rewritten whole).
+
+JOB_DIR = os.environ.get('SCHOOL_JOB_DIR')
+WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# Submissions are refused while this many jobs are waiting
+MAX_QUEUED = 50
+# A job that has crashed its process this many times is not retried
+MAX_ATTEMPTS = 3
+HEARTBEAT_SECONDS = 10
+STALE_SECONDS = 3 * HEARTBEAT_SECONDS
+# Progress is written at most this often; cancellation is noticed as fast
+PROGRESS_INTERVAL = 0.5
+# Finished jobs and their files are deleted after this many days
+KEEP_DAYS = 7
+
+STATUSES = ('queued', 'running', 'done', 'failed', 'cancelled')
+
+JOB_COLUMNS = ('id, kind, params, status, progress, total, message, result, result_name, result_type, '
+               'error, attempts, cancel_requested, created_at, started_at, finished_at')
+
+KINDS = {}
+
+registry.describe('jobs_finished_total', 'Background jobs finished, by kind and outcome')
+
+_executor = None
+_sweeper = None
+_lock = threading.Lock()
+# Jobs running in this process, by id, and the ids waiting in its pool
+_active = {}
+_scheduled = set()
+
+
+def _owner():
+    # Worked out per call: pre-forked server workers share this module with their parent
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobError(ValueError):
+    """A job that cannot be submitted, or a result that is not there"""
+
+
+class JobsBusy(Exception):
+    """Too many jobs are already waiting"""
+
+
+class JobCancelled(Exception):
+    """Raised inside a job function when its job has been cancelled"""
+
+
+def configure(job_dir=None, workers=None):
+    """Keep job files in another directory, or change the pool size before the first job"""
+    global JOB_DIR, WORKERS
+    if job_dir:
+        JOB_DIR = job_dir
+    if workers:
+        WORKERS = workers
+
+
+def job_dir():
+    """Directory of job inputs and results (default: job_files/ next to the database)"""
+    return JOB_DIR or os.path.join(os.path.dirname(os.path.abspath(connection.DATABASE)), 'job_files')
+
+
+def kind(name, prepare=None):
+    """Register fn(job, **params) as the function that runs jobs of this kind
+
+    prepare(params) runs at submission and returns the params to store,
+    raising JobError for ones that are wrong. fn may return a JSON-able
+    summary, which becomes the job's result.
+    """
+    def register(fn):
+        KINDS[name] = (fn, prepare)
+        return fn
+    return register
+
+
+class Job:
+    """A running job as its function sees it: params, progress and result file"""
+
+    def __init__(self, job_id, kind, params):
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.cancelled = False
+        self.done = None
+        self._reported = 0.0
+
+    def directory(self):
+        return os.path.join(job_dir(), str(self.id))
+
+    def progress(self, done, total=None, message=None):
+        """Record how far the job has got; raises JobCancelled once it is cancelled"""
+        if self.cancelled:
+            raise JobCancelled()
+        self.done = done
+        now = time.monotonic()
+        if now - self._reported < PROGRESS_INTERVAL:
+            return
+        self._reported = now
+        with connection.connection() as db:
+            row = db.execute('''
+                UPDATE jobs SET progress = ?, total = COALESCE(?, total), message = COALESCE(?, message),
+                                heartbeat_at = CURRENT_TIMESTAMP
+                WHERE id = ? RETURNING cancel_requested''', (done, total, message, self.id)).fetchone()
+            db.commit()
+        if row is not None and row[0]:
+            self.cancelled = True
+            raise JobCancelled()
+
+    def result_path(self, filename, mimetype):
+        """Path to write the job's downloadable result to"""
+        os.makedirs(self.directory(), exist_ok=True)
+        with connection.connection() as db:
+            db.execute('UPDATE jobs SET result_name = ?, result_type = ? WHERE id = ?',
+                       (filename, mimetype, self.id))
+            db.commit()
+        return os.path.join(self.directory(), filename)
+
+
+def _job_dict(row):
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    job['result'] = json.loads(job['result']) if job['result'] is not None else None
+    job['cancel_requested'] = bool(job['cancel_requested'])
+    return job
+
+
+def submit(kind_name, params=None, files=None, unique=False):
+    """Queue a job and return its id
+
+    files maps a param name to (filename, binary file object); each is
+    copied into the job's directory and the param set to its path (to its
+    file name while the kind's prepare() checks the params). With unique,
+    the id of a queued or running job of the same kind and params is
+    returned instead, checked under the same write lock as the insert.
+    Raises JobError for an unknown kind or bad params, JobsBusy when the
+    queue is full.
+    """
+    if kind_name not in KINDS:
+        raise JobError(f'unknown job kind {kind_name}')
+    params = dict(params or {})
+    files = files or {}
+    # Uploads are copied before the write lock is taken, then moved into place
+    staged = None
+    if files:
+        os.makedirs(job_dir(), exist_ok=True)
+        staged = tempfile.mkdtemp(prefix='.upload-', dir=job_dir())
+    try:
+        for param, (filename, stream) in files.items():
+            name = f'{param}{os.path.splitext(filename)[1].lower()}'
+            with open(os.path.join(staged, name), 'wb') as f:
+                shutil.copyfileobj(stream, f, 1024 * 1024)
+            params[param] = name
+        prepare = KINDS[kind_name][1]
+        if prepare is not None:
+            params = prepare(params)
+        with connection.connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                if unique:
+                    existing = db.execute("""
+                        SELECT id FROM jobs WHERE kind = ? AND params = ? AND status IN ('queued', 'running')
+                        ORDER BY id LIMIT 1""", (kind_name, json.dumps(params))).fetchone()
+                    if existing is not None:
+                        db.rollback()
+                        return existing[0]
+                queued = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+                if queued >= MAX_QUEUED:
+                    raise JobsBusy(f'{queued} jobs are already waiting')
+                job_id = db.execute('INSERT INTO jobs (kind, params) VALUES (?, ?)',
+                                    (kind_name, json.dumps(params))).lastrowid
+                if staged is not None:
+                    directory = os.path.join(job_dir(), str(job_id), 'input')
+                    os.makedirs(os.path.dirname(directory), exist_ok=True)
+                    os.replace(staged, directory)
+                    staged = None
+                    for param in files:
+                        params[param] = os.path.join(directory, params[param])
+                    db.execute('UPDATE jobs SET params = ? WHERE id = ?', (json.dumps(params), job_id))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+    finally:
+        if staged is not None:
+            shutil.rmtree(staged, ignore_errors=True)
+    _schedule(job_id)
+    return job_id
+
+
+def get_job(job_id):
+    """A job as a dict, or None"""
+    with connection.connection() as db:
+        row = db.execute(f'SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return _job_dict(row) if row is not None else None
+
+
+def list_jobs(kind_name=None, statuses=None, limit=50):
+    """Most recent jobs first, optionally of one kind and in some statuses"""
+    conditions = []
+    params = []
+    if kind_name:
+        conditions.append('kind = ?')
+        params.append(kind_name)
+    if statuses:
+        conditions.append('status IN (SELECT value FROM json_each(?))')
+        params.append(json.dumps(list(statuses)))
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    with connection.connection() as db:
+        rows = db.execute(f'SELECT {JOB_COLUMNS} FROM jobs {where} ORDER BY id DESC LIMIT ?',
+                          (*params, limit)).fetchall()
+    return [_job_dict(row) for row in rows]
+
+
+def cancel(job_id):
+    """Cancel a job: at once if it is still queued, at its next progress report if running
+
+    Returns the job, or None if there is no such job.
+    """
+    with connection.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute("""
+                UPDATE jobs SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'queued'""", (job_id,))
+            db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    job = _active.get(job_id)
+    if job is not None:
+        job.cancelled = True
+    return get_job(job_id)
+
+
+def result_file(job_id):
+    """(path, filename, mimetype) of a finished job's result; raises JobError if there is none"""
+    job = get_job(job_id)
+    if job is None or job['status'] != 'done' or not job['result_name']:
+        raise JobError('the job has no result to download')
+    path = os.path.join(job_dir(), str(job_id), job['result_name'])
+    if not os.path.exists(path):
+        raise JobError('the job result has been deleted')
+    return path, job['result_name'], job['result_type']
+
+
+# Running jobs
+
+def _pool():
+    global _executor, _sweeper
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(WORKERS, thread_name_prefix='job')
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep_forever, name='job-sweeper', daemon=True)
+            _sweeper.start()
+        return _executor
+
+
+def _schedule(job_id):
+    with _lock:
+        if job_id in _scheduled:
+            return
+        _scheduled.add(job_id)
+    _pool().submit(_run, job_id)
+
+
+def _claim(job_id):
+    with connection.connection() as db:
+        row = db.execute("""
+            UPDATE jobs SET status = 'running', owner = ?, attempts = attempts + 1,
+                            started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'queued'
+            RETURNING kind, params""", (_owner(), job_id)).fetchone()
+        db.commit()
+    return row
+
+
+def _finish(job, status, result=None, error=None):
+    # Progress reports are throttled, so record the last one
+    with connection.connection() as db:
+        db.execute("""
+            UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = CURRENT_TIMESTAMP,
+                            progress = CASE WHEN ? = 'done' THEN COALESCE(total, ?, progress)
+                                            ELSE COALESCE(?, progress) END
+            WHERE id = ?""", (status, json.dumps(result) if result is not None else None, error,
+                              status, job.done, job.done, job.id))
+        db.commit()
+
+
+def _run(job_id):
+    with _lock:
+        _scheduled.discard(job_id)
+    row = _claim(job_id)
+    if row is None:
+        # Cancelled while queued, or claimed by another process
+        return
+    job = Job(job_id, row['kind'], json.loads(row['params']))
+    _active[job_id] = job
+    try:
+        fn = KINDS[job.kind][0]
+        result = fn(job, **job.params)
+    except JobCancelled:
+        _finish(job, 'cancelled')
+        shutil.rmtree(job.directory(), ignore_errors=True)
+        registry.inc('jobs_finished_total', kind=job.kind, status='cancelled')
+        log.info('Job %d (%s) cancelled', job_id, job.kind)
+    except Exception as e:
+        log.exception('Job %d (%s) failed', job_id, job.kind)
+        _finish(job, 'failed', error=str(e) or type(e).__name__)
+        registry.inc('jobs_finished_total', kind=job.kind, status='failed')
+    else:
+        _finish(job, 'done', result=result)
+        registry.inc('jobs_finished_total', kind=job.kind, status='done')
+        log.info('Job %d (%s) done', job_id, job.kind)
+    finally:
+        _active.pop(job_id, None)
+
+
+def sweep():
+    """Heartbeat this process's jobs, requeue dead processes' jobs and drop expired ones
+
+    Returns the ids scheduled to run here.
+    """
+    with connection.connection() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if _active:
+                db.execute('UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP '
+                           'WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(list(_active)),))
+            stale = f'-{STALE_SECONDS} seconds'
+            db.execute("""
+                UPDATE jobs SET status = 'failed', finished_at = CURRENT_TIMESTAMP,
+                                error = 'stopped with its process too many times'
+                WHERE status = 'running' AND heartbeat_at < datetime('now', ?) AND attempts >= ?""",
+                       (stale, MAX_ATTEMPTS))
+            db.execute("""
+                UPDATE jobs SET status = 'queued', owner = NULL
+                WHERE status = 'running' AND heartbeat_at < datetime('now', ?)""", (stale,))
+            # Queued by a process that stopped before running them
+            waiting = [row[0] for row in db.execute("""
+                SELECT id FROM jobs WHERE status = 'queued' AND created_at < datetime('now', ?)
+                ORDER BY id""", (stale,))]
+            expired = [row[0] for row in db.execute("""
+                DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled')
+                AND finished_at < datetime('now', ?) RETURNING id""", (f'-{KEEP_DAYS} days',))]
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    for job_id in expired:
+        shutil.rmtree(os.path.join(job_dir(), str(job_id)), ignore_errors=True)
+    for job_id in waiting:
+        _schedule(job_id)
+    return waiting
+
+
+def _sweep_forever():
+    while True:
+        time.sleep(HEARTBEAT_SECONDS)
+        try:
+            sweep()
+        except Exception:
+            log.exception('Job sweep failed')
+
+
+def resume_jobs():
+    """Start the sweeper and pick up jobs a previous run left queued or running"""
+    _pool()
+    return sweep()
+
+
+def shutdown(wait=True):
+    """Stop taking jobs; running ones are requeued on the next start if not waited for"""
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait, cancel_futures=True)
+            _executor = None
+
+
+def _counts_by_status():
+    with connection.connection() as db:
+        counts = dict(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+    return [({'status': status}, counts.get(status, 0)) for status in STATUSES]
+
+
+registry.gauge('jobs', 'Background jobs by status', _counts_by_status)
@@ -0,0 +1,155 @@
+import bisect
+import functools
+import threading
+import time
+
+# In-process metrics rendered in the Prometheus text format. Histograms and
+# counters are keyed by metric name plus a small set of labels; gauges are
+# callbacks read at scrape time, so they cost nothing between scrapes.
+
+# Latency buckets in seconds, from cache hits to long exports
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Return (cumulative counts per bucket including +Inf, sum)"""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Named histograms, counters and gauges"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        key = _label_key(labels)
+        series = self._histograms.get(name)
+        histogram = series.get(key) if series is not None else None
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, {}).setdefault(key, Histogram())
+        histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def gauge(self, name, help_text, read, kind='gauge'):
+        """Register a value read at scrape time
+
+        read() returns a number or a list of (labels dict, number). Use
+        kind='counter' for running totals kept elsewhere (e.g. cache hits).
+        """
+        self._help[name] = help_text
+        self._gauges[name] = (read, kind)
+
+    def render(self):
+        """Everything in the Prometheus text exposition format"""
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f'# HELP {name} {self._help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            histograms = {name: dict(series) for name, series in self._histograms.items()}
+            counters = {name: dict(series) for name, series in self._counters.items()}
+        for name, series in sorted(histograms.items()):
+            header(name, 'histogram')
+            for key, histogram in sorted(series.items()):
+                cumulative, total = histogram.snapshot()
+                for bound, count in zip(histogram.buckets + ('+Inf',), cumulative):
+                    le = bound if bound == '+Inf' else _format_value(bound)
+                    lines.append(f'{name}_bucket{_format_labels(key + (("le", le),))} {count}')
+                lines.append(f'{name}_sum{_format_labels(key)} {_format_value(total)}')
+                lines.append(f'{name}_count{_format_labels(key)} {cumulative[-1]}')
+        for name, series in sorted(counters.items()):
+            header(name, 'counter')
+            for key, value in sorted(series.items()):
+                lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        for name, (read, kind) in sorted(self._gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                continue
+            header(name, kind)
+            samples = value if isinstance(value, list) else [({}, value)]
+            for labels, sample in samples:
+                lines.append(f'{name}{_format_labels(_label_key(labels))} {_format_value(sample)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+registry.describe('db_query_seconds', 'Time spent in database helpers, by helper name')
+registry.describe('db_query_errors_total', 'Database helpers that raised, by helper name')
+registry.describe('db_slow_queries_total', 'Statements slower than the slow-query threshold')
+
+
+def timed(fn):
+    """Record a helper's duration in db_query_seconds{query=<function name>}"""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            registry.inc('db_query_errors_total', query=name)
+            raise
+        finally:
+            registry.observe('db_query_seconds', time.perf_counter() - started, query=name)
+
+    return wrapper
@@ -0,0 +1,326 @@
+import logging
+
+from db import photostore
+from db.connection import connection
+
+log = logging.getLogger(__name__)
+
+# Versioned schema migrations. Each entry in MIGRATIONS is
+# (version, description, function); the schema version lives in
+# PRAGMA user_version and run_migrations() applies every pending entry in
+# order, one transaction per migration. Append new migrations, never edit
+# ones that have shipped.
+
+
+def _columns(db, table):
+    return [row[1] for row in db.execute(f'PRAGMA table_info({table})')]
+
+
+def initial_schema(db):
+    """Create the base tables and add students.photo to older databases"""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS students (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idno TEXT UNIQUE NOT NULL,
+            firstname TEXT NOT NULL,
+            lastname TEXT NOT NULL,
+            course TEXT NOT NULL,
+            level TEXT NOT NULL,
+            photo BLOB,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS attendance (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id INTEGER NOT NULL,
+            time_in TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            date DATE DEFAULT CURRENT_DATE,
+            FOREIGN KEY (student_id) REFERENCES students(id)
+        )''')
+    if 'photo' not in _columns(db, 'students'):
+        db.execute('ALTER TABLE students ADD COLUMN photo BLOB')
+
+
+def attendance_indexes(db):
+    """Index attendance for the per-day lookups and enforce one row per student per day"""
+    # Older rows may carry a full timestamp in the date column
+    db.execute('UPDATE attendance SET date = DATE(date) WHERE date IS NOT DATE(date)')
+    # Keep the earliest scan when a student was recorded twice on the same day
+    db.execute('''
+        DELETE FROM attendance
+        WHERE id NOT IN (SELECT MIN(id) FROM attendance GROUP BY student_id, date)
+    ''')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_attendance_student_date ON attendance (student_id, date)')
+    db.execute('CREATE INDEX IF NOT EXISTS ix_attendance_date_student ON attendance (date, student_id)')
+    db.execute('CREATE INDEX IF NOT EXISTS ix_attendance_time_in ON attendance (time_in)')
+
+
+def photos_to_store(db):
+    """Move students.photo BLOBs into the photo store and keep only their hash"""
+    db.execute('ALTER TABLE students ADD COLUMN photo_hash TEXT')
+    rows = db.execute('SELECT id, photo FROM students WHERE photo IS NOT NULL').fetchall()
+    for student_id, photo in rows:
+        db.execute('UPDATE students SET photo_hash = ? WHERE id = ?',
+                   (photostore.put(photo), student_id))
+    db.execute('ALTER TABLE students DROP COLUMN photo')
+
+
+def roster_generation(db):
+    """Count changes to students so caches in every process can tell when to refresh"""
+    db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID')
+    db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('roster_generation', 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS students_generation_{event.lower()}
+            AFTER {event} ON students
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'roster_generation';
+            END''')
+
+
+def scan_receipts(db):
+    """Remember client idempotency keys of batched kiosk scans"""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS scan_receipts (
+            key TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID''')
+
+
+def student_sort_key(db):
+    """Add an indexed IDNO sort key: numeric IDNOs in numeric order, then the rest"""
+    db.execute('''
+        ALTER TABLE students ADD COLUMN idno_key TEXT GENERATED ALWAYS AS (
+            CASE WHEN idno <> '' AND idno NOT GLOB '*[^0-9]*'
+                 THEN '0' || printf('%020d', CAST(idno AS INTEGER))
+                 ELSE '1' || idno
+            END) VIRTUAL''')
+    db.execute('CREATE INDEX IF NOT EXISTS ix_students_idno_key ON students (idno_key, id)')
+    db.execute('CREATE INDEX IF NOT EXISTS ix_students_course_level_key ON students (course, level, idno_key, id)')
+    db.execute('CREATE INDEX IF NOT EXISTS ix_students_level_key ON students (level, idno_key, id)')
+
+
+def student_search_index(db):
+    """FTS5 index over the roster, kept in sync by triggers on students"""
+    db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS students_fts USING fts5(
+            idno, firstname, lastname, course,
+            content='students', content_rowid='id',
+            prefix='1 2 3', tokenize='unicode61 remove_diacritics 2'
+        )''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS students_fts_insert AFTER INSERT ON students
+        BEGIN
+            INSERT INTO students_fts (rowid, idno, firstname, lastname, course)
+            VALUES (new.id, new.idno, new.firstname, new.lastname, new.course);
+        END''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS students_fts_delete AFTER DELETE ON students
+        BEGIN
+            INSERT INTO students_fts (students_fts, rowid, idno, firstname, lastname, course)
+            VALUES ('delete', old.id, old.idno, old.firstname, old.lastname, old.course);
+        END''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS students_fts_update
+        AFTER UPDATE OF idno, firstname, lastname, course ON students
+        BEGIN
+            INSERT INTO students_fts (students_fts, rowid, idno, firstname, lastname, course)
+            VALUES ('delete', old.id, old.idno, old.firstname, old.lastname, old.course);
+            INSERT INTO students_fts (rowid, idno, firstname, lastname, course)
+            VALUES (new.id, new.idno, new.firstname, new.lastname, new.course);
+        END''')
+    db.execute("INSERT INTO students_fts (students_fts) VALUES ('rebuild')")
+
+
+def rebuild_attendance_daily(db):
+    """Recompute attendance_daily from the attendance table (caller holds the transaction)"""
+    db.execute('DELETE FROM attendance_daily')
+    db.execute('''
+        INSERT INTO attendance_daily (date, course, level, present)
+        SELECT a.date, s.course, s.level, COUNT(*)
+        FROM attendance a
+        JOIN students s ON s.id = a.student_id
+        GROUP BY a.date, s.course, s.level''')
+
+
+def attendance_daily_aggregates(db):
+    """Per-(date, course, level) present counts, maintained by triggers"""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS attendance_daily (
+            date TEXT NOT NULL,
+            course TEXT NOT NULL,
+            level TEXT NOT NULL,
+            present INTEGER NOT NULL,
+            PRIMARY KEY (date, course, level)
+        ) WITHOUT ROWID''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS attendance_daily_insert AFTER INSERT ON attendance
+        BEGIN
+            INSERT INTO attendance_daily (date, course, level, present)
+            SELECT new.date, course, level, 1 FROM students WHERE id = new.student_id
+            ON CONFLICT (date, course, level) DO UPDATE SET present = present + 1;
+        END''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS attendance_daily_delete AFTER DELETE ON attendance
+        BEGIN
+            UPDATE attendance_daily SET present = present - 1
+            WHERE date = old.date
+              AND (course, level) = (SELECT course, level FROM students WHERE id = old.student_id);
+            DELETE FROM attendance_daily WHERE date = old.date AND present <= 0;
+        END''')
+    # Counts follow the student's current course and level, like a rebuild
+    # would, so moving a student moves their history with them
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS attendance_daily_regroup
+        AFTER UPDATE OF course, level ON students
+        WHEN old.course IS NOT new.course OR old.level IS NOT new.level
+        BEGIN
+            UPDATE attendance_daily SET present = present - (
+                SELECT COUNT(*) FROM attendance
+                WHERE student_id = new.id AND attendance.date = attendance_daily.date)
+            WHERE course = old.course AND level = old.level
+              AND date IN (SELECT date FROM attendance WHERE student_id = new.id);
+            DELETE FROM attendance_daily
+            WHERE course = old.course AND level = old.level AND present <= 0;
+            INSERT INTO attendance_daily (date, course, level, present)
+            SELECT date, new.course, new.level, COUNT(*) FROM attendance
+            WHERE student_id = new.id GROUP BY date
+            ON CONFLICT (date, course, level) DO UPDATE SET present = present + excluded.present;
+        END''')
+    rebuild_attendance_daily(db)
+
+
+def attendance_archive(db):
+    """Bookkeeping for per-term attendance archives (see db/archive.py)"""
+    # Flags set and cleared inside one maintenance transaction, so only
+    # that transaction's own triggers ever see them
+    db.execute('CREATE TABLE IF NOT EXISTS maintenance_flags (name TEXT PRIMARY KEY) WITHOUT ROWID')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS archived_terms (
+            name TEXT PRIMARY KEY,
+            first_date DATE NOT NULL,
+            last_date DATE NOT NULL,
+            filename TEXT NOT NULL,
+            moved_through INTEGER NOT NULL DEFAULT 0,
+            row_count INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'running',
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )''')
+    # Archived rows keep counting in attendance_daily
+    db.execute('DROP TRIGGER IF EXISTS attendance_daily_delete')
+    db.execute('''
+        CREATE TRIGGER attendance_daily_delete AFTER DELETE ON attendance
+        WHEN NOT EXISTS (SELECT 1 FROM maintenance_flags WHERE name = 'archiving')
+        BEGIN
+            UPDATE attendance_daily SET present = present - 1
+            WHERE date = old.date
+              AND (course, level) = (SELECT course, level FROM students WHERE id = old.student_id);
+            DELETE FROM attendance_daily WHERE date = old.date AND present <= 0;
+        END''')
+
+
+def background_jobs(db):
+    """Queue and state of background jobs (see db/jobs.py)"""
+    # AUTOINCREMENT: ids name job directories, so a deleted job's id is never reused
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            message TEXT,
+            result TEXT,
+            result_name TEXT,
+            result_type TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            heartbeat_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )''')
+    # The sweeper looks up unfinished jobs by status and heartbeat
+    db.execute('CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status, heartbeat_at)')
+
+
+MIGRATIONS = [
+    (1, 'initial schema and students.photo', initial_schema),
+    (2, 'attendance indexes and per-day uniqueness', attendance_indexes),
+    (3, 'move student photos to the photo store', photos_to_store),
+    (4, 'roster generation counter', roster_generation),
+    (5, 'scan receipts for batched attendance', scan_receipts),
+    (6, 'indexed student sort key', student_sort_key),
+    (7, 'full-text student search', student_search_index),
+    (8, 'daily attendance aggregates', attendance_daily_aggregates),
+    (9, 'attendance archive bookkeeping', attendance_archive),
+    (10, 'background jobs', background_jobs),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(db):
+    """Get the schema version recorded in the database"""
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def run_migrations():
+    """Apply all pending migrations and return the resulting schema version"""
+    with connection() as db:
+        if get_schema_version(db) >= LATEST_VERSION:
+            return LATEST_VERSION
+        for version, description, migrate in MIGRATIONS:
+            # Take the write lock before re-reading the version so concurrent
+            # workers starting together apply each migration only once
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                if get_schema_version(db) >= version:
+                    db.rollback()
+                    continue
+                log.info("Applying migration %d: %s", version, description)
+                migrate(db)
+                db.execute(f'PRAGMA user_version = {version}')
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        # Give space freed by a migration (e.g. moved photos) back to the OS
+        free_pages = db.execute('PRAGMA freelist_count').fetchone()[0]
+        total_pages = db.execute('PRAGMA page_count').fetchone()[0]
+        if free_pages * 4 > total_pages:
+            db.execute('VACUUM')
+        return get_schema_version(db)
+
+
+def explain(db, sql, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement"""
+    return [row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+def check_query_plans(queries):
+    """Return {name: plan} for every query whose plan falls back to a full SCAN
+
+    queries maps a name to (sql, sample_params). Covering-index scans are
+    reported too, since they still read every row.
+    """
+    problems = {}
+    with connection() as db:
+        for name, (sql, params) in queries.items():
+            plan = explain(db, sql, params)
+            if any(line.startswith('SCAN') for line in plan):
+                problems[name] = plan
+    return problems
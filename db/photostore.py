@@ -0,0 +1,164 @@
+import hashlib
+import os
+import tempfile
+
+# Content-addressed photo store. Each image is written once to
+# PHOTO_DIR/<first two hex digits>/<sha256>, and students.photo_hash points
+# at it, so the students table only carries a 64-character reference.
+PHOTO_DIR = os.environ.get('SCHOOL_PHOTO_DIR', os.path.join(os.path.dirname(__file__), 'photos'))
+
+# Limits for streamed uploads (see put_stream)
+MAX_PHOTO_BYTES = 5 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+)
+
+
+class PhotoRejected(ValueError):
+    """An upload that is not an acceptable image"""
+
+
+class PhotoTooLarge(PhotoRejected):
+    """An upload over the size limit"""
+
+
+def configure(photo_dir):
+    """Point the store at another directory"""
+    global PHOTO_DIR
+    PHOTO_DIR = photo_dir
+
+
+def path_for(photo_hash):
+    """Get the file path for a photo hash"""
+    return os.path.join(PHOTO_DIR, photo_hash[:2], photo_hash)
+
+
+def is_valid_hash(photo_hash):
+    """Check that a string looks like a sha256 hex digest"""
+    return (isinstance(photo_hash, str) and len(photo_hash) == 64
+            and all(c in '0123456789abcdef' for c in photo_hash))
+
+
+def image_type(head):
+    """MIME type for the first bytes of a JPEG or PNG, else None"""
+    for signature, kind in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return kind
+    return None
+
+
+def spool(stream, directory, max_bytes=MAX_PHOTO_BYTES, chunk_size=CHUNK_SIZE):
+    """Copy an image stream to a temp file in directory, hashing it on the way
+
+    Returns (temp path, sha256 hex digest, MIME type); the caller renames the
+    file into place. Only chunk_size bytes are held in memory at a time.
+    Raises PhotoRejected (PhotoTooLarge past max_bytes) as soon as the data
+    is known to be bad, and never leaves the temp file behind on error.
+    """
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    digest = hashlib.sha256()
+    head = b''
+    kind = None
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise PhotoTooLarge(f'photo is larger than {max_bytes // (1024 * 1024)}MB')
+                if kind is None and len(head) < 8:
+                    head += chunk[:8]
+                    if len(head) >= 8:
+                        kind = image_type(head)
+                        if kind is None:
+                            raise PhotoRejected('photo is not a JPEG or PNG image')
+                digest.update(chunk)
+                f.write(chunk)
+        if kind is None:
+            kind = image_type(head)
+            if kind is None:
+                raise PhotoRejected('photo is empty' if not size else 'photo is not a JPEG or PNG image')
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), kind
+
+
+def put_stream(stream, max_bytes=MAX_PHOTO_BYTES):
+    """Store an image read from a file-like object and return its hash"""
+    tmp_path, photo_hash, _ = spool(stream, PHOTO_DIR, max_bytes)
+    path = path_for(photo_hash)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        return photo_hash
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    return photo_hash
+
+
+def put(data):
+    """Store image bytes and return their hash; existing content is not rewritten"""
+    photo_hash = hashlib.sha256(data).hexdigest()
+    path = path_for(photo_hash)
+    if os.path.exists(path):
+        return photo_hash
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temp file and rename so readers never see a partial image
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return photo_hash
+
+
+def get(photo_hash):
+    """Read a stored photo, or None if it is missing"""
+    if not is_valid_hash(photo_hash):
+        return None
+    try:
+        with open(path_for(photo_hash), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def mimetype(photo_hash):
+    """Guess a stored photo's MIME type from its first bytes"""
+    with open(path_for(photo_hash), 'rb') as f:
+        head = f.read(8)
+    return image_type(head) or 'image/jpeg'
+
+
+def size(photo_hash):
+    """Size in bytes of a stored photo, or None if it is missing"""
+    if not is_valid_hash(photo_hash):
+        return None
+    try:
+        return os.path.getsize(path_for(photo_hash))
+    except FileNotFoundError:
+        return None
+
+
+def prune(referenced):
+    """Delete stored photos whose hash is not in referenced; returns the count"""
+    removed = 0
+    if not os.path.isdir(PHOTO_DIR):
+        return removed
+    for directory, _, files in os.walk(PHOTO_DIR):
+        for name in files:
+            if is_valid_hash(name) and name not in referenced:
+                os.remove(os.path.join(directory, name))
+                removed += 1
+    return removed
@@ -0,0 +1,58 @@
+import threading
+
+from db.connection import connection
+
+
+class DailyPresence:
+    """Ids of the students already marked present on the current day
+
+    The set only ever holds a subset of what the database knows: an id that
+    is missing (written by another process, or before a failed warm-up) just
+    costs a trip to the database, where the UNIQUE (student_id, date) index
+    still has the final say. A new date empties the set and reloads it.
+    """
+
+    def __init__(self):
+        self.date = None
+        self._present = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def warm(self, date_str):
+        """Load the day's present students from the database"""
+        with connection() as db:
+            ids = {row[0] for row in db.execute('SELECT student_id FROM attendance WHERE date = ?', (date_str,))}
+        with self._lock:
+            if self.date != date_str:
+                self.date = date_str
+                self._present = set()
+            self._present |= ids
+
+    def contains(self, student_id, date_str):
+        if self.date != date_str:
+            self.warm(date_str)
+        with self._lock:
+            if self.date == date_str and student_id in self._present:
+                self.hits += 1
+                return True
+            return False
+
+    def add(self, student_id, date_str):
+        with self._lock:
+            if self.date == date_str:
+                self._present.add(student_id)
+
+    def discard(self, student_id):
+        with self._lock:
+            self._present.discard(student_id)
+
+    def clear(self):
+        with self._lock:
+            self.date = None
+            self._present = set()
+
+    def __len__(self):
+        return len(self._present)
+
+
+today_presence = DailyPresence()
@@ -0,0 +1,145 @@
+from db.archive import read_with_archives
+from db.cache import LRUCache
+from db.connection import read_connection
+from db.metrics import registry, timed
+
+# Range reports over the attendance table. School days are the dates in the
+# range on which anyone was marked present (taken from attendance_daily), so
+# weekends and holidays never count as absences.
+#
+# Results are memoized per (report, range, filters). A cached result carries
+# a fingerprint of the range -- the roster generation plus the number of
+# aggregate rows and present total in the range -- and is recomputed when the
+# fingerprint changes. Attendance is only ever added, except when a student
+# is deleted (which bumps the roster generation), so any write that touches
+# the range changes the fingerprint. Archiving a term moves rows without
+# changing the aggregates, and results stay the same across the move.
+#
+# Attendance is read from the live table plus the archive of every term the
+# range reaches (see db/archive.py), one correlated subquery per source.
+
+RATE_COLUMNS = ('idno', 'lastname', 'firstname', 'course', 'level', 'present', 'school_days', 'rate')
+ABSENTEE_COLUMNS = ('idno', 'lastname', 'firstname', 'course', 'level', 'date')
+
+# Absentee lists grow with days x students; bigger results are not memoized
+MAX_CACHED_ROWS = 100000
+
+_cache = LRUCache(maxsize=64)
+
+SCHOOL_DAYS_CTE = """
+    WITH days AS MATERIALIZED (
+        SELECT DISTINCT date FROM attendance_daily WHERE date BETWEEN :start AND :end
+    )
+"""
+
+RATES_SQL = SCHOOL_DAYS_CTE + """
+    SELECT s.idno, s.lastname, s.firstname, s.course, s.level,
+           {present} AS present, (SELECT COUNT(*) FROM days) AS school_days
+    FROM students s
+    {where}
+    ORDER BY s.idno_key, s.id
+"""
+
+PRESENT_SQL = '(SELECT COUNT(*) FROM {table} a WHERE a.student_id = s.id AND a.date BETWEEN :start AND :end{moved})'
+
+# Students drive the loop (in IDNO order), each probing the unique
+# (student_id, date) index of every source once per school day
+ABSENTEES_SQL = SCHOOL_DAYS_CTE + """
+    SELECT s.idno, s.lastname, s.firstname, s.course, s.level, d.date
+    FROM students s
+    CROSS JOIN days d
+    WHERE {absent} {filters}
+    ORDER BY s.idno_key, s.id, d.date
+"""
+
+ABSENT_SQL = 'NOT EXISTS (SELECT 1 FROM {table} a WHERE a.student_id = s.id AND a.date = d.date{moved})'
+
+FINGERPRINT_SQL = """
+    SELECT (SELECT value FROM meta WHERE key = 'roster_generation'),
+           COUNT(*), COALESCE(SUM(present), 0)
+    FROM attendance_daily WHERE date BETWEEN ? AND ?
+"""
+
+
+def _student_filters(course, level):
+    conditions = []
+    params = {}
+    if course:
+        conditions.append('s.course = :course')
+        params['course'] = course
+    if level:
+        conditions.append('s.level = :level')
+        params['level'] = level
+    return conditions, params
+
+
+def _sources(archives):
+    """(table, extra condition) per attendance source, and the parameters they use"""
+    sources = [('attendance', '')]
+    params = {}
+    for n, (schema, moved_through) in enumerate(archives):
+        sources.append((f'{schema}.attendance', f' AND a.id <= :moved_{n}'))
+        params[f'moved_{n}'] = moved_through
+    return sources, params
+
+
+def _rates(db, start, end, course, level, archives):
+    conditions, params = _student_filters(course, level)
+    sources, source_params = _sources(archives)
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    present = ' + '.join(PRESENT_SQL.format(table=table, moved=moved) for table, moved in sources)
+    rows = []
+    for row in db.execute(RATES_SQL.format(present=present, where=where),
+                          dict(params, **source_params, start=start, end=end)):
+        days = row['school_days']
+        rows.append(tuple(row) + (round(row['present'] / days, 4) if days else 0.0,))
+    return rows
+
+
+def _absentees(db, start, end, course, level, archives):
+    conditions, params = _student_filters(course, level)
+    sources, source_params = _sources(archives)
+    filters = ''.join(' AND ' + condition for condition in conditions)
+    absent = ' AND '.join(ABSENT_SQL.format(table=table, moved=moved) for table, moved in sources)
+    return [tuple(row) for row in db.execute(ABSENTEES_SQL.format(absent=absent, filters=filters),
+                                             dict(params, **source_params, start=start, end=end))]
+
+
+REPORTS = {
+    'rates': (RATE_COLUMNS, _rates),
+    'absentees': (ABSENTEE_COLUMNS, _absentees),
+}
+
+
+@timed
+def run_report(kind, start, end, course=None, level=None):
+    """Return (columns, rows) for a report between two YYYY-MM-DD dates
+
+    kind is 'rates' (one row per student: days present, school days and
+    rate) or 'absentees' (one row per school day a student missed, grouped
+    by student).
+    """
+    columns, compute = REPORTS[kind]
+    key = (kind, start, end, course or None, level or None)
+    # One read transaction, so the fingerprint matches the rows computed
+    with read_connection() as db, read_with_archives(db, start, end) as archives:
+        fingerprint = tuple(db.execute(FINGERPRINT_SQL, (start, end)).fetchone())
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            return columns, cached[1]
+        rows = compute(db, start, end, course, level, archives)
+    if len(rows) <= MAX_CACHED_ROWS:
+        _cache.set(key, (fingerprint, rows))
+    return columns, rows
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def cache_stats():
+    return {'size': len(_cache), 'hits': _cache.hits, 'misses': _cache.misses}
+
+
+registry.gauge('report_cache_lookups_total', 'Report cache lookups by result',
+               lambda: [({'result': 'hit'}, _cache.hits), ({'result': 'miss'}, _cache.misses)], kind='counter')
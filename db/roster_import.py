@@ -0,0 +1,179 @@
+import csv
+import io
+import os
+import zipfile
+
+from db import photostore
+from db.cache import student_cache
+from db.connection import connection
+from db.metrics import timed
+
+# Bulk roster import: a CSV with idno, firstname, lastname, course and level
+# columns, plus an optional zip of photos named <idno>.jpg / .jpeg / .png.
+# Rows are validated as they are read and upserted chunk by chunk, one
+# transaction per chunk.
+
+REQUIRED_COLUMNS = ('idno', 'firstname', 'lastname', 'course', 'level')
+COURSES = ('BSIT', 'BSCS', 'BSCPE', 'BSE')
+LEVELS = ('1', '2', '3', '4')
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MAX_PHOTO_BYTES = 5 * 1024 * 1024
+MAX_REPORTED_ERRORS = 1000
+
+UPSERT_STUDENT_SQL = """
+    INSERT INTO students (idno, firstname, lastname, course, level, photo_hash)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (idno) DO UPDATE SET
+        firstname = excluded.firstname,
+        lastname = excluded.lastname,
+        course = excluded.course,
+        level = excluded.level,
+        photo_hash = COALESCE(excluded.photo_hash, students.photo_hash)
+"""
+
+
+class RosterImportError(Exception):
+    """The upload as a whole cannot be imported (bad header, bad zip)"""
+
+
+def _photo_index(photos_zip):
+    """Map idno -> ZipInfo for every image in the zip"""
+    index = {}
+    for info in photos_zip.infolist():
+        if info.is_dir():
+            continue
+        name, extension = os.path.splitext(os.path.basename(info.filename))
+        if extension.lower() in PHOTO_EXTENSIONS and not name.startswith('.'):
+            index[name] = info
+    return index
+
+
+def _read_photo(photos_zip, info):
+    """Read and sanity-check one photo from the zip"""
+    if info.file_size > MAX_PHOTO_BYTES:
+        raise ValueError('photo is larger than 5MB')
+    data = photos_zip.read(info)
+    if not (data.startswith(b'\xff\xd8') or data.startswith(b'\x89PNG')):
+        raise ValueError('photo is not a JPEG or PNG image')
+    return data
+
+
+def validate_row(row):
+    """Normalise one CSV row; returns the student tuple or raises ValueError"""
+    values = {column: (row.get(column) or '').strip() for column in REQUIRED_COLUMNS}
+    missing = [column for column in REQUIRED_COLUMNS if not values[column]]
+    if missing:
+        raise ValueError('missing ' + ', '.join(missing))
+    values['course'] = values['course'].upper()
+    if values['course'] not in COURSES:
+        raise ValueError(f"unknown course {values['course']!r}")
+    if values['level'] not in LEVELS:
+        raise ValueError(f"level must be one of {', '.join(LEVELS)}")
+    return tuple(values[column] for column in REQUIRED_COLUMNS)
+
+
+def _write_chunk(db, chunk, report):
+    idnos = [student[0] for student in chunk]
+    marks = ','.join('?' * len(idnos))
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        existing = {row[0] for row in db.execute(f'SELECT idno FROM students WHERE idno IN ({marks})', idnos)}
+        db.executemany(UPSERT_STUDENT_SQL, chunk)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    updated = sum(1 for idno in idnos if idno in existing)
+    report['updated'] += updated
+    report['inserted'] += len(chunk) - updated
+
+
+@timed
+def import_students(csv_file, photos_file=None, chunk_size=500, progress=None):
+    """Import a roster CSV (binary file object) and return a report dict
+
+    The report has counts of rows, inserted, updated, photos and skipped
+    rows (rows = inserted + updated + skipped), and an 'errors' list of {'row', 'idno', 'message'} entries where
+    row is the CSV line number. progress(rows), if given, is called after
+    every committed chunk and may raise to stop the import there.
+    """
+    report = {'rows': 0, 'inserted': 0, 'updated': 0, 'photos': 0, 'skipped': 0,
+              'errors': [], 'errors_truncated': False}
+
+    def error(line, idno, message):
+        report['skipped'] += 1
+        if len(report['errors']) < MAX_REPORTED_ERRORS:
+            report['errors'].append({'row': line, 'idno': idno, 'message': message})
+        else:
+            report['errors_truncated'] = True
+
+    photos_zip = None
+    photo_index = {}
+    if photos_file is not None:
+        try:
+            photos_zip = zipfile.ZipFile(photos_file)
+        except zipfile.BadZipFile:
+            raise RosterImportError('Photos must be a .zip file')
+        photo_index = _photo_index(photos_zip)
+
+    text = io.TextIOWrapper(csv_file, encoding='utf-8-sig', newline='')
+    reader = csv.DictReader(text)
+    try:
+        fieldnames = reader.fieldnames
+    except (UnicodeDecodeError, csv.Error):
+        text.detach()
+        raise RosterImportError('The file is not UTF-8 CSV; save it as "CSV UTF-8"')
+    if fieldnames is None:
+        raise RosterImportError('The CSV file is empty')
+    reader.fieldnames = [name.strip().lower() for name in fieldnames]
+    missing = [column for column in REQUIRED_COLUMNS if column not in reader.fieldnames]
+    if missing:
+        raise RosterImportError('CSV is missing column(s): ' + ', '.join(missing))
+
+    seen = set()
+    chunk = []
+    with connection() as db:
+        try:
+            for row in reader:
+                report['rows'] += 1
+                line = reader.line_num
+                idno = (row.get('idno') or '').strip()
+                try:
+                    student = validate_row(row)
+                except ValueError as e:
+                    error(line, idno, str(e))
+                    continue
+                if idno in seen:
+                    error(line, idno, 'duplicate idno earlier in the file')
+                    continue
+                seen.add(idno)
+
+                photo_hash = None
+                if idno in photo_index:
+                    try:
+                        photo_hash = photostore.put(_read_photo(photos_zip, photo_index[idno]))
+                        report['photos'] += 1
+                    except (ValueError, zipfile.BadZipFile) as e:
+                        error(line, idno, str(e))
+                        continue
+                chunk.append(student + (photo_hash,))
+                if len(chunk) >= chunk_size:
+                    _write_chunk(db, chunk, report)
+                    chunk = []
+                    if progress is not None:
+                        progress(report['rows'])
+            if chunk:
+                _write_chunk(db, chunk, report)
+        except (UnicodeDecodeError, csv.Error) as e:
+            # Rows read before the bad spot still go in; the rest of the file
+            # counts as one skipped row
+            if chunk:
+                _write_chunk(db, chunk, report)
+            report['rows'] += 1
+            error(reader.line_num + 1, None, f'unreadable CSV: {e}')
+        finally:
+            text.detach()
+            if photos_zip is not None:
+                photos_zip.close()
+            student_cache.invalidate()
+    return report
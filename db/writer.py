@@ -0,0 +1,114 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from db import connection
+
+# Durability presets for the writer connection's synchronous pragma.
+# 'full' fsyncs the WAL on every group commit, 'normal' only at checkpoints
+# (a power cut may lose the last few batches), 'off' leaves it to the OS.
+DURABILITY = {'full': 'FULL', 'normal': 'NORMAL', 'off': 'OFF'}
+
+
+class WriterBusy(Exception):
+    """Raised when the attendance write queue stays full"""
+
+
+class AttendanceWriter:
+    """Dedicated thread that group-commits attendance inserts
+
+    Callers hand over (student_id, time_in, date) and block until the batch
+    holding their row is committed. The thread drains the queue until it has
+    max_batch rows or max_delay seconds have passed since the first one, then
+    writes them all in one transaction, so a burst of scans costs one commit
+    (and one fsync) instead of one per scan.
+    """
+
+    def __init__(self, insert_sql, max_batch=200, max_delay=0.005, queue_size=2000,
+                 durability='normal', submit_timeout=0.5, commit_timeout=10):
+        self.insert_sql = insert_sql
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.submit_timeout = submit_timeout
+        self.commit_timeout = commit_timeout
+        self.synchronous = DURABILITY[durability]
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._stopping = threading.Event()
+        self.batches = 0
+        self.rows = 0
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """Finish queued writes and stop the thread"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def submit(self, student_id, time_in, date):
+        """Queue one insert and wait until it is committed; returns True if a row was added"""
+        future = Future()
+        try:
+            self._queue.put((student_id, time_in, date, future), timeout=self.submit_timeout)
+        except queue.Full:
+            raise WriterBusy('attendance write queue is full')
+        return future.result(timeout=self.commit_timeout)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        db = connection.get_pool().acquire()
+        db.execute(f'PRAGMA synchronous = {self.synchronous}')
+        try:
+            while not (self._stopping.is_set() and self._queue.empty()):
+                batch = self._next_batch()
+                if batch:
+                    self._write(db, batch)
+        finally:
+            db.execute(f"PRAGMA synchronous = {connection.PRAGMAS['synchronous']}")
+            db.close()
+
+    def _write(self, db, batch):
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            added = [db.execute(self.insert_sql, row[:3]).rowcount == 1 for row in batch]
+            db.commit()
+        except Exception as e:
+            if db.in_transaction:
+                db.rollback()
+            for row in batch:
+                row[3].set_exception(e)
+            return
+        self.batches += 1
+        self.rows += len(batch)
+        for row, was_added in zip(batch, added):
+            row[3].set_result(was_added)
@@ -0,0 +1,68 @@
+import csv
+import io
+import json
+import zlib
+
+# Helpers that turn row iterators into streamed response bodies. Rows are
+# sequences in the order of the column names; output is produced in chunks
+# of about chunk_rows rows so memory stays flat however long the export is.
+
+
+def csv_stream(columns, rows, chunk_rows=500):
+    """Yield CSV text: a header line, then the rows in chunks"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    # Send the header straight away so the download starts immediately
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_stream(columns, rows, chunk_rows=500):
+    """Yield newline-delimited JSON, one object per row"""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row)), default=str))
+        if len(lines) == chunk_rows:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def gzip_stream(chunks):
+    """Gzip-compress a stream of text chunks on the fly"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+FORMATS = {
+    'csv': (csv_stream, 'text/csv'),
+    'ndjson': (ndjson_stream, 'application/x-ndjson'),
+}
+
+
+def stream_body(fmt, columns, rows, gzip=False):
+    """Build (body iterator, mimetype, file extension) for an export format"""
+    encode, mimetype = FORMATS[fmt]
+    body = encode(columns, rows)
+    extension = fmt
+    if gzip:
+        body = gzip_stream(body)
+        mimetype = 'application/gzip'
+        extension += '.gz'
+    return body, mimetype, extension
@@ -0,0 +1,354 @@
+import functools
+import re
+import struct
+import zlib
+
+# A small QR code encoder (ISO/IEC 18004), enough for student IDNOs: byte
+# mode, error correction level M, versions 1-10 (up to 213 bytes). encode()
+# returns the module matrix; png() and svg_path() render it.
+
+# Per version at level M: (EC codewords per block, [(block count, data codewords per block), ...])
+EC_BLOCKS_M = {
+    1: (10, [(1, 16)]),
+    2: (16, [(1, 28)]),
+    3: (26, [(1, 44)]),
+    4: (18, [(2, 32)]),
+    5: (24, [(2, 43)]),
+    6: (16, [(4, 27)]),
+    7: (18, [(4, 31)]),
+    8: (22, [(2, 38), (2, 39)]),
+    9: (22, [(3, 36), (2, 37)]),
+    10: (26, [(4, 43), (1, 44)]),
+}
+
+ALIGNMENT_POSITIONS = {
+    1: [], 2: [6, 18], 3: [6, 22], 4: [6, 26], 5: [6, 30], 6: [6, 34],
+    7: [6, 22, 38], 8: [6, 24, 42], 9: [6, 26, 46], 10: [6, 28, 50],
+}
+
+FORMAT_EC_BITS_M = 0b00
+MAX_VERSION = max(EC_BLOCKS_M)
+
+
+class QRCapacityError(ValueError):
+    """The text does not fit in the largest supported version"""
+
+
+# GF(256) arithmetic for Reed-Solomon, primitive polynomial x^8+x^4+x^3+x^2+1
+_EXP = [0] * 512
+_LOG = [0] * 256
+_value = 1
+for _i in range(255):
+    _EXP[_i] = _value
+    _LOG[_value] = _i
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= 0x11D
+for _i in range(255, 512):
+    _EXP[_i] = _EXP[_i - 255]
+
+
+def _gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+@functools.lru_cache(maxsize=None)
+def _rs_generator(degree):
+    poly = [1]
+    for i in range(degree):
+        # Multiply by (x - a^i); subtraction is XOR in GF(256)
+        poly = [a ^ _gf_mul(b, _EXP[i]) for a, b in zip(poly + [0], [0] + poly)]
+    return tuple(poly)
+
+
+def _rs_remainder(data, generator):
+    remainder = [0] * (len(generator) - 1)
+    for byte in data:
+        factor = byte ^ remainder[0]
+        remainder = remainder[1:] + [0]
+        if factor:
+            for i, coefficient in enumerate(generator[1:]):
+                remainder[i] ^= _gf_mul(coefficient, factor)
+    return remainder
+
+
+def _data_capacity(version):
+    _, groups = EC_BLOCKS_M[version]
+    return sum(count * size for count, size in groups)
+
+
+def _choose_version(length):
+    for version in range(1, MAX_VERSION + 1):
+        count_bits = 8 if version < 10 else 16
+        if 4 + count_bits + 8 * length <= 8 * _data_capacity(version):
+            return version
+    raise QRCapacityError(f'{length} bytes is too long for a version {MAX_VERSION} QR code')
+
+
+def _data_codewords(payload, version):
+    count_bits = 8 if version < 10 else 16
+    capacity = _data_capacity(version) * 8
+    bits = [0, 1, 0, 0]  # byte mode
+    bits += [(len(payload) >> i) & 1 for i in reversed(range(count_bits))]
+    for byte in payload:
+        bits += [(byte >> i) & 1 for i in reversed(range(8))]
+    bits += [0] * min(4, capacity - len(bits))
+    bits += [0] * (-len(bits) % 8)
+    codewords = [int(''.join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8)]
+    pad = 0xEC
+    while len(codewords) < capacity // 8:
+        codewords.append(pad)
+        pad ^= 0xEC ^ 0x11
+    return codewords
+
+
+def _interleave(codewords, version):
+    ec_length, groups = EC_BLOCKS_M[version]
+    generator = _rs_generator(ec_length)
+    blocks = []
+    offset = 0
+    for count, size in groups:
+        for _ in range(count):
+            block = codewords[offset:offset + size]
+            offset += size
+            blocks.append((block, _rs_remainder(block, generator)))
+    result = []
+    for i in range(max(len(data) for data, _ in blocks)):
+        result += [data[i] for data, _ in blocks if i < len(data)]
+    for i in range(ec_length):
+        result += [ec[i] for _, ec in blocks]
+    return result
+
+
+class _Matrix:
+    def __init__(self, version):
+        self.version = version
+        self.size = version * 4 + 17
+        self.modules = [[False] * self.size for _ in range(self.size)]
+        self.reserved = [[False] * self.size for _ in range(self.size)]
+
+    def copy(self):
+        """A matrix with its own modules; the reserved map is shared"""
+        other = _Matrix.__new__(_Matrix)
+        other.version, other.size = self.version, self.size
+        other.modules = [row[:] for row in self.modules]
+        other.reserved = self.reserved
+        return other
+
+    def set_function(self, x, y, dark):
+        self.modules[y][x] = dark
+        self.reserved[y][x] = True
+
+    def draw_function_patterns(self):
+        size = self.size
+        for i in range(size):
+            self.set_function(6, i, i % 2 == 0)
+            self.set_function(i, 6, i % 2 == 0)
+        for x, y in ((3, 3), (size - 4, 3), (3, size - 4)):
+            self._draw_finder(x, y)
+        positions = ALIGNMENT_POSITIONS[self.version]
+        last = len(positions) - 1
+        for i, x in enumerate(positions):
+            for j, y in enumerate(positions):
+                # Skip the three corners taken by finder patterns
+                if (i, j) in ((0, 0), (0, last), (last, 0)):
+                    continue
+                self._draw_alignment(x, y)
+        self.draw_format_bits(0)
+        self._draw_version()
+
+    def _draw_finder(self, cx, cy):
+        for dy in range(-4, 5):
+            for dx in range(-4, 5):
+                x, y = cx + dx, cy + dy
+                if 0 <= x < self.size and 0 <= y < self.size:
+                    self.set_function(x, y, max(abs(dx), abs(dy)) not in (2, 4))
+
+    def _draw_alignment(self, cx, cy):
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                self.set_function(cx + dx, cy + dy, max(abs(dx), abs(dy)) != 1)
+
+    def draw_format_bits(self, mask):
+        data = FORMAT_EC_BITS_M << 3 | mask
+        remainder = data
+        for _ in range(10):
+            remainder = (remainder << 1) ^ ((remainder >> 9) * 0x537)
+        bits = (data << 10 | remainder) ^ 0x5412
+        bit = [(bits >> i) & 1 == 1 for i in range(15)]
+        size = self.size
+        # Around the top-left finder
+        for i in range(6):
+            self.set_function(8, i, bit[i])
+        self.set_function(8, 7, bit[6])
+        self.set_function(8, 8, bit[7])
+        self.set_function(7, 8, bit[8])
+        for i in range(9, 15):
+            self.set_function(14 - i, 8, bit[i])
+        # Split between the other two finders
+        for i in range(8):
+            self.set_function(size - 1 - i, 8, bit[i])
+        for i in range(8, 15):
+            self.set_function(8, size - 15 + i, bit[i])
+        self.set_function(8, size - 8, True)
+
+    def _draw_version(self):
+        if self.version < 7:
+            return
+        remainder = self.version
+        for _ in range(12):
+            remainder = (remainder << 1) ^ ((remainder >> 11) * 0x1F25)
+        bits = self.version << 12 | remainder
+        for i in range(18):
+            dark = (bits >> i) & 1 == 1
+            a, b = self.size - 11 + i % 3, i // 3
+            self.set_function(a, b, dark)
+            self.set_function(b, a, dark)
+
+    def draw_codewords(self, codewords):
+        size = self.size
+        total_bits = len(codewords) * 8
+        i = 0
+        right = size - 1
+        while right >= 1:
+            if right == 6:
+                right = 5
+            upward = ((right + 1) & 2) == 0
+            for vertical in range(size):
+                y = size - 1 - vertical if upward else vertical
+                for x in (right, right - 1):
+                    if not self.reserved[y][x] and i < total_bits:
+                        self.modules[y][x] = (codewords[i >> 3] >> (7 - (i & 7))) & 1 == 1
+                        i += 1
+            right -= 2
+
+    def rows(self):
+        """The modules as one integer per row, leftmost module in the top bit"""
+        return [int(''.join('1' if dark else '0' for dark in row), 2) for row in self.modules]
+
+
+MASKS = (
+    lambda x, y: (x + y) % 2 == 0,
+    lambda x, y: y % 2 == 0,
+    lambda x, y: x % 3 == 0,
+    lambda x, y: (x + y) % 3 == 0,
+    lambda x, y: (x // 3 + y // 2) % 2 == 0,
+    lambda x, y: x * y % 2 + x * y % 3 == 0,
+    lambda x, y: (x * y % 2 + x * y % 3) % 2 == 0,
+    lambda x, y: ((x + y) % 2 + x * y % 3) % 2 == 0,
+)
+
+
+# Penalty rules 1 and 3: runs of five or more, and finder-like 1:1:3:1:1
+# patterns with four light modules on either side (neither pattern can
+# overlap itself, so str.count finds them all)
+_RUNS = re.compile('00000+|11111+')
+FINDER_LIKE = ('10111010000', '00001011101')
+
+
+@functools.lru_cache(maxsize=None)
+def _function_patterns(version):
+    """An empty matrix with the function patterns drawn; copy() before use"""
+    matrix = _Matrix(version)
+    matrix.draw_function_patterns()
+    return matrix
+
+
+@functools.lru_cache(maxsize=None)
+def _mask_rows(version, mask):
+    """A mask pattern as row integers, clear over the function patterns"""
+    matrix = _function_patterns(version)
+    condition = MASKS[mask]
+    return tuple(
+        int(''.join('1' if not matrix.reserved[y][x] and condition(x, y) else '0' for x in range(matrix.size)), 2)
+        for y in range(matrix.size))
+
+
+@functools.lru_cache(maxsize=None)
+def _format_rows(version, mask):
+    """The format information for a mask as row integers, on an empty matrix"""
+    matrix = _Matrix(version)
+    matrix.draw_format_bits(mask)
+    return tuple(matrix.rows())
+
+
+def _penalty(rows, size):
+    lines = [format(row, f'0{size}b') for row in rows]
+    # Rows and columns in one string; the separator stops matches spanning lines
+    text = '2'.join(lines + [''.join(column) for column in zip(*lines)])
+    score = sum(len(run) - 2 for run in _RUNS.findall(text))
+    score += 40 * sum(text.count(pattern) for pattern in FINDER_LIKE)
+    # Rule 2: 2x2 blocks of one colour, found with bit operations on row pairs
+    pairs = (1 << (size - 1)) - 1
+    for upper, lower in zip(rows, rows[1:]):
+        same = ~(upper ^ lower)
+        blocks = ~(upper ^ upper >> 1) & ~(lower ^ lower >> 1) & same & same >> 1 & pairs
+        score += 3 * bin(blocks).count('1')
+    # Rule 4: distance of the dark proportion from 50%, in 5% steps
+    dark = sum(bin(row).count('1') for row in rows)
+    total = size * size
+    score += 10 * ((abs(dark * 20 - total * 10) + total - 1) // total - 1)
+    return score
+
+
+def encode(text, mask=None):
+    """Encode text as a QR code; returns rows of booleans (True = dark)
+
+    The mask with the lowest penalty score is used unless one is given.
+    """
+    payload = text.encode('utf-8')
+    version = _choose_version(len(payload))
+    matrix = _function_patterns(version).copy()
+    matrix.draw_codewords(_interleave(_data_codewords(payload, version), version))
+    # draw_function_patterns() left mask 0's format bits in place; each
+    # candidate swaps them for its own and applies its pattern, all as XORs
+    rows = matrix.rows()
+    drawn = _format_rows(version, 0)
+    candidates = range(len(MASKS)) if mask is None else [mask]
+    best = None
+    for candidate in candidates:
+        masked = [row ^ old ^ new ^ pattern for row, old, new, pattern in
+                  zip(rows, drawn, _format_rows(version, candidate), _mask_rows(version, candidate))]
+        score = _penalty(masked, matrix.size) if mask is None else 0
+        if best is None or score < best[0]:
+            best = (score, masked)
+    size = matrix.size
+    return [[(row >> (size - 1 - x)) & 1 == 1 for x in range(size)] for row in best[1]]
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def png(modules, scale=8, border=4):
+    """Render a module matrix as a 1-bit greyscale PNG"""
+    width = (len(modules) + 2 * border) * scale
+    padding = -width % 8
+    quiet = '1' * (border * scale)
+    blank = [False] * len(modules)
+    raw = bytearray()
+    for row in [blank] * border + modules + [blank] * border:
+        # 1 is white in a greyscale PNG
+        bits = quiet + ''.join(('0' if dark else '1') * scale for dark in row) + quiet + '0' * padding
+        raw += (b'\x00' + int(bits, 2).to_bytes((width + padding) // 8, 'big')) * scale
+    header = struct.pack('>IIBBBBB', width, width, 1, 0, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header)
+            + _png_chunk(b'IDAT', zlib.compress(bytes(raw), 9)) + _png_chunk(b'IEND', b''))
+
+
+def svg_path(modules, border=4):
+    """SVG path data drawing the dark modules, one unit per module"""
+    parts = []
+    for y, row in enumerate(modules):
+        x = 0
+        while x < len(row):
+            if row[x]:
+                start = x
+                while x < len(row) and row[x]:
+                    x += 1
+                parts.append(f'M{start + border},{y + border}h{x - start}v1h{start - x}z')
+            else:
+                x += 1
+    return ''.join(parts)
@@ -0,0 +1,162 @@
+"""Production server: pre-forked worker processes, each serving with a thread pool
+
+    python serve.py --host 0.0.0.0 --port 8000 --workers 4 --threads 16
+
+The parent binds the socket and brings the schema up to date, then forks
+the workers. They share the listening socket, warm up their own pools,
+caches and templates, and serve requests on --threads threads each. A
+worker that dies is replaced; SIGTERM or Ctrl+C stops them all. Where
+there is no fork (Windows), or with --workers 1, one process serves.
+
+Each open attendance live feed holds a thread for up to five minutes, so
+leave threads to spare for the admins watching it.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+from app import create_app, warm_up
+from db import connection
+from db.dbhelper import stop_attendance_writer
+from db.migrations import run_migrations
+
+log = logging.getLogger('serve')
+
+# A worker that exits this soon after starting is failing to start, not crashing
+RESPAWN_DELAY = 1.0
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server handing each connection to a fixed pool of threads"""
+
+    # Set before BaseWSGIServer.__init__ reads it: keep-alive and HTTP/1.1
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd=None):
+        super().__init__(host, port, app, fd=fd)
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='http')
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def close(self):
+        # Not server_close(): BaseWSGIServer.__init__ calls that when handed an fd
+        self.server_close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _stop(signum, frame):
+    raise SystemExit(0)
+
+
+def serve(app, args, fd=None):
+    """Warm this process up and serve until stopped"""
+    warm_up(app)
+    server = PooledWSGIServer(args.host, args.port, app, args.threads, fd=fd)
+    signal.signal(signal.SIGTERM, _stop)
+    log.info('Worker %d serving on %s:%d with %d threads', os.getpid(), args.host, args.port, args.threads)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        # Flush inserts the group-commit writer is still holding
+        stop_attendance_writer()
+
+
+def _fork_worker(app, args, listener):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            serve(app, args, fd=listener.fileno())
+        except SystemExit as e:
+            code = e.code or 0
+        except BaseException:
+            log.exception('Worker %d failed', os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def run_prefork(app, args):
+    listener = socket.create_server((args.host, args.port), backlog=args.backlog,
+                                    family=socket.AF_INET6 if ':' in args.host else socket.AF_INET)
+    # Migrate once here, then close the connections so no worker inherits one
+    run_migrations()
+    connection.close_pools()
+
+    workers = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(args.workers):
+        workers[_fork_worker(app, args, listener)] = time.monotonic()
+    log.info('Serving on %s:%d with %d workers', args.host, args.port, args.workers)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = workers.pop(pid, None)
+        if started is None or stopping:
+            continue
+        log.warning('Worker %d exited with status %d; starting another', pid, os.waitstatus_to_exitcode(status))
+        if time.monotonic() - started < RESPAWN_DELAY:
+            time.sleep(RESPAWN_DELAY)
+        workers[_fork_worker(app, args, listener)] = time.monotonic()
+    listener.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=os.environ.get('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', 0)) or os.cpu_count() or 1,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WEB_THREADS', 16)),
+                        help='request threads per worker')
+    parser.add_argument('--backlog', type=int, default=128)
+    args = parser.parse_args()
+
+    # Built once in the parent so workers share its code and templates
+    app = create_app({'WARM_UP': False})
+    if args.workers > 1 and hasattr(os, 'fork'):
+        run_prefork(app, args)
+    else:
+        serve(app, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
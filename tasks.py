@@ -0,0 +1,148 @@
+from contextlib import nullcontext
+from datetime import datetime
+
+from cards import CHUNK_SIZE, build_zip, zip_name
+from db import archive, jobs
+from db.dbhelper import EXPORT_COLUMNS, iter_attendance, prune_photos, select_students
+from db.roster_import import import_students
+from exports import FORMATS, stream_body
+
+# The kinds of background job the admin pages can start (see db/jobs.py).
+# Each prepare function checks a submission's params and returns the ones
+# stored with the job; each job function reports progress as it goes, which
+# is also where a cancelled job stops.
+
+# Rows between progress reports of an export
+EXPORT_PROGRESS_ROWS = 1000
+
+
+def _flag(value):
+    return value in (True, 1, '1', 'true', 'yes')
+
+
+def _date(params, name):
+    value = params.get(name) or None
+    if value is not None:
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+        except (TypeError, ValueError):
+            raise jobs.JobError('Dates must be YYYY-MM-DD')
+    return value
+
+
+# Roster import
+
+def _prepare_import(params):
+    if not params.get('roster'):
+        raise jobs.JobError('Please choose a CSV file')
+    return {'roster': params['roster'], 'photos': params.get('photos')}
+
+
+@jobs.kind('import', prepare=_prepare_import)
+def import_job(job, roster, photos=None):
+    """Import a roster CSV and optional photo zip; the result is the import report"""
+    with open(roster, 'rb') as f:
+        total = max(sum(1 for _ in f) - 1, 0)
+    job.progress(0, total)
+    with open(roster, 'rb') as csv_file, (open(photos, 'rb') if photos else nullcontext()) as photos_file:
+        return import_students(csv_file, photos_file, progress=lambda rows: job.progress(rows, total))
+
+
+# Attendance export
+
+def _prepare_export(params):
+    fmt = params.get('format') or 'csv'
+    if fmt not in FORMATS:
+        raise jobs.JobError('format must be csv or ndjson')
+    return {'format': fmt, 'start': _date(params, 'start'), 'end': _date(params, 'end'),
+            'course': params.get('course') or None, 'level': params.get('level') or None,
+            'gzip': _flag(params.get('gzip'))}
+
+
+@jobs.kind('export', prepare=_prepare_export)
+def export_job(job, format, start=None, end=None, course=None, level=None, gzip=False):
+    """Write the attendance export to a file for download"""
+    written = 0
+
+    def rows():
+        nonlocal written
+        for row in iter_attendance(start, end, course, level):
+            written += 1
+            if written % EXPORT_PROGRESS_ROWS == 0:
+                job.progress(written)
+            yield row
+
+    body, mimetype, extension = stream_body(format, EXPORT_COLUMNS, rows(), gzip=gzip)
+    path = job.result_path(f"attendance_{start or 'all'}_{end or 'all'}.{extension}", mimetype)
+    with open(path, 'wb') as f:
+        for chunk in body:
+            f.write(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+    return {'rows': written}
+
+
+# QR codes and ID cards
+
+def _prepare_qrcodes(params):
+    ids = params.get('ids')
+    try:
+        if isinstance(ids, str):
+            ids = [int(value) for value in ids.split(',') if value.strip()]
+        elif ids is not None:
+            ids = [int(value) for value in ids]
+    except (TypeError, ValueError):
+        raise jobs.JobError('ids must be comma-separated student ids')
+    return {'ids': ids or None, 'course': params.get('course') or None, 'level': params.get('level') or None,
+            'cards': _flag(params.get('cards'))}
+
+
+@jobs.kind('qrcodes', prepare=_prepare_qrcodes)
+def qrcodes_job(job, ids=None, course=None, level=None, cards=False):
+    """Build the QR code (and ID card) zip into a file for download"""
+    students = select_students(ids, course, level)
+    if not students:
+        raise jobs.JobError('No students selected')
+    job.progress(0, len(students))
+    path = job.result_path(zip_name(course, level, cards), 'application/zip')
+    with open(path, 'wb') as f:
+        # One piece per chunk of students, then the zip directory
+        for n, data in enumerate(build_zip(students, cards=cards), 1):
+            f.write(data)
+            job.progress(min(n * CHUNK_SIZE, len(students)))
+    return {'students': len(students)}
+
+
+# Attendance archiving
+
+def _prepare_archive(params):
+    name = params.get('name') or ''
+    if archive.get_term(name) is None:
+        raise jobs.JobError(f'no archived term named {name}')
+    return {'name': name}
+
+
+@jobs.kind('archive', prepare=_prepare_archive)
+def archive_job(job, name):
+    """Move a registered term into its archive; cancelling pauses the move"""
+    try:
+        return {'moved': archive.archive_term(name, progress=job.progress)}
+    except jobs.JobCancelled:
+        archive.pause_term(name)
+        raise
+
+
+def start_archive(name):
+    """Queue an archive job for a term unless one is already queued or running; returns its id"""
+    return jobs.submit('archive', {'name': name}, unique=True)
+
+
+def resume_archives():
+    """Queue the moves of terms a previous run left half done"""
+    return [start_archive(name) for name in archive.unfinished_terms()]
+
+
+# Photo store
+
+@jobs.kind('prune_photos')
+def prune_photos_job(job):
+    """Delete stored photos no student refers to"""
+    return {'removed': prune_photos()}